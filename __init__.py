@@ -1,8 +1,11 @@
+import asyncio
+
 from fastapi import APIRouter
 from starlette.staticfiles import StaticFiles
 
 from lnbits.db import Database
 from lnbits.helpers import template_renderer
+from lnbits.tasks import catch_everything_and_restart
 
 db = Database("ext_atmbitbit")
 
@@ -21,6 +24,36 @@ def atmbitbit_renderer():
     return template_renderer(["lnbits/extensions/atmbitbit/templates"])
 
 
+from .audit import audit_log  # noqa: E402
+from .bootstrap import dashboard_bootstrap  # noqa: E402
+from .exchange_rates import exchange_rate_streams  # noqa: E402
 from .lnurl_api import *  # noqa: F401,F403
+from .rate_history import exchange_rate_history  # noqa: E402
+from .tasks import (  # noqa: E402
+    flush_exchange_rate_history,
+    refresh_wallet_liquidity,
+)
+from .traffic import traffic_recorder  # noqa: E402
 from .views import *  # noqa: F401,F403
 from .views_api import *  # noqa: F401,F403
+from .webhooks import webhook_dispatcher  # noqa: E402
+
+
+def atmbitbit_start():
+    dashboard_bootstrap.build()
+    loop = asyncio.get_event_loop()
+    loop.create_task(catch_everything_and_restart(flush_exchange_rate_history))
+    loop.create_task(catch_everything_and_restart(refresh_wallet_liquidity))
+    loop.create_task(catch_everything_and_restart(audit_log.run))
+    loop.create_task(catch_everything_and_restart(webhook_dispatcher.run))
+
+
+@atmbitbit_ext.on_event("shutdown")
+async def atmbitbit_stop():
+    for stream in exchange_rate_streams.values():
+        stream.stop()
+    await exchange_rate_history.flush()
+    await audit_log.flush()
+    if traffic_recorder:
+        # Writes the records still queued for the writer thread.
+        traffic_recorder.stop()
@@ -0,0 +1,125 @@
+import asyncio
+import heapq
+import itertools
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+# Lower values are admitted first.
+PRIORITY_CALLBACK = 0
+PRIORITY_CREATE = 1
+
+priority_names = {PRIORITY_CALLBACK: "callback", PRIORITY_CREATE: "create"}
+
+# Seconds a request may wait for a slot before it is shed.
+default_latency_targets = {PRIORITY_CALLBACK: 10.0, PRIORITY_CREATE: 1.0}
+
+
+class AdmissionShed(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Lets at most max_concurrent requests run at once. Waiting requests are
+    admitted by priority, then in arrival order. A request that waited longer
+    than the latency target of its priority is shed with AdmissionShed.
+
+    A request is shed on arrival already when its expected wait exceeds the
+    target: one average service time (a moving average of how long admitted
+    requests hold their slot) per max_concurrent requests ahead of it, plus
+    the ones running.
+
+    Requests hold their slot until they are done, including the payment of a
+    callback, so max_concurrent also caps the number of concurrent payments.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 32,
+        latency_targets: Optional[Dict[int, float]] = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.latency_targets = latency_targets or dict(default_latency_targets)
+        self.active = 0
+        self.waiting = 0
+        # Moving average of the seconds a slot is held, None until measured.
+        self.service_time: Optional[float] = None
+        self.admitted = {name: 0 for name in priority_names.values()}
+        self.shed = {name: 0 for name in priority_names.values()}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "waiting": self.waiting,
+            "service_time": self.service_time,
+            "admitted": dict(self.admitted),
+            "shed": dict(self.shed),
+        }
+
+    @asynccontextmanager
+    async def admit(self, priority: int) -> AsyncIterator[None]:
+        name = priority_names[priority]
+        if self.active < self.max_concurrent and not self.waiting:
+            self.active += 1
+        elif self.get_expected_wait(priority) > self.latency_targets[priority]:
+            # It would only be shed after waiting for nothing.
+            self.shed[name] += 1
+            raise AdmissionShed()
+        else:
+            future = asyncio.get_event_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(future, self.latency_targets[priority])
+            except asyncio.TimeoutError:
+                self.waiting -= 1
+                self.shed[name] += 1
+                raise AdmissionShed()
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Admitted right before the request was cancelled.
+                    self._release()
+                else:
+                    self.waiting -= 1
+                raise
+        self.admitted[name] += 1
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            yield
+        finally:
+            self._observe(loop.time() - started)
+            self._release()
+
+    def get_expected_wait(self, priority: int) -> float:
+        if self.service_time is None:
+            return 0.0
+        ahead = sum(
+            1
+            for waiter_priority, _, future in self._waiters
+            if waiter_priority <= priority and not future.done()
+        )
+        return (ahead + 1) * self.service_time / self.max_concurrent
+
+    def _observe(self, duration: float) -> None:
+        if self.service_time is None:
+            self.service_time = duration
+        else:
+            self.service_time += 0.2 * (duration - self.service_time)
+
+    def _release(self) -> None:
+        self.active -= 1
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            # Shed waiters leave their cancelled future behind.
+            if not future.done():
+                self.active += 1
+                self.waiting -= 1
+                future.set_result(None)
+                break
+
+
+admission_controller = AdmissionController()
@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+from typing import List, Optional, Tuple
+
+from loguru import logger
+
+from . import db
+
+AuditEvent = Tuple[int, str, Optional[str], str, str]
+
+
+class AuditLog:
+    """
+    Append-only audit trail of ATM withdrawals. log() only puts the event on
+    a bounded in-memory queue; run() writes the queue in batches of up to
+    batch_size events, or whatever arrived within flush_interval seconds.
+
+    When the queue is full, new events are dropped and counted in "dropped"
+    so that auditing can never hold up a withdrawal. A batch that couldn't be
+    written is kept and retried with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        retry_delay: float = 1.0,
+        max_retry_delay: float = 60.0,
+    ):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.dropped = 0
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._batch: List[AuditEvent] = []
+
+    def log(
+        self, event: str, atmbitbit: str, lnurl: Optional[str] = None, **data
+    ) -> None:
+        try:
+            self._queue.put_nowait(
+                (int(time.time()), atmbitbit, lnurl, event, json.dumps(data))
+            )
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"AtmBitBit audit log queue full, dropped {event} event")
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        delay = self.retry_delay
+        while True:
+            if not self._batch:
+                self._batch.append(await self._queue.get())
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+            if await self._write():
+                delay = self.retry_delay
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    async def flush(self) -> None:
+        while not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+        if not await self._write():
+            # Nothing retries after shutdown.
+            self.dropped += len(self._batch)
+            logger.error(f"Dropped {len(self._batch)} unwritten AtmBitBit audit events")
+            self._batch = []
+
+    async def _write(self) -> bool:
+        batch, self._batch = self._batch, []
+        if not batch:
+            return True
+        try:
+            # All events of a batch are committed together.
+            async with db.connect() as conn:
+                for event in batch:
+                    await conn.execute(
+                        """
+                        INSERT INTO atmbitbit.audit_log (time, atmbitbit, lnurl, event, data)
+                        VALUES (?, ?, ?, ?, ?)
+                        """,
+                        event,
+                    )
+        except Exception as e:
+            logger.error(f"Failed to write {len(batch)} AtmBitBit audit events: {e}")
+            # Keep the batch for the next attempt, up to max_queue_size events.
+            self._batch = batch[: self.max_queue_size]
+            if len(batch) > self.max_queue_size:
+                self.dropped += len(batch) - self.max_queue_size
+            return False
+        return True
+
+
+audit_log = AuditLog()
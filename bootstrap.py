@@ -0,0 +1,43 @@
+import hashlib
+import json
+from typing import Optional, Tuple
+
+from .exchange_rates import (
+    get_exchange_rate_providers_serializable,
+    get_fiat_currencies,
+)
+
+
+class DashboardBootstrap:
+    """
+    The static data of the dashboard (fiat currencies and exchange rate
+    providers), serialized once. Its version is a hash of the body, so a URL
+    carrying the version can be cached for good.
+    """
+
+    def __init__(self):
+        self._bootstrap: Optional[Tuple[bytes, str]] = None
+
+    def build(self) -> None:
+        body = json.dumps(
+            {
+                "exchange_rate_providers": get_exchange_rate_providers_serializable(),
+                "fiat_currencies": get_fiat_currencies(),
+            },
+            separators=(",", ":"),
+            sort_keys=True,
+        ).encode()
+        self._bootstrap = (body, hashlib.sha256(body).hexdigest()[:16])
+
+    def get(self) -> Tuple[bytes, str]:
+        if not self._bootstrap:
+            self.build()
+        assert self._bootstrap
+        return self._bootstrap
+
+    @property
+    def version(self) -> str:
+        return self.get()[1]
+
+
+dashboard_bootstrap = DashboardBootstrap()
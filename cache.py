@@ -0,0 +1,65 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+FetchGenerations = Callable[[List[str]], Awaitable[Dict[str, int]]]
+
+
+class GenerationCache:
+    """
+    In-process cache whose entries belong to a wallet and remember that
+    wallet's generation (see the "generations" table) when they were loaded.
+
+    Other workers bump the generation when they write, so at most once per
+    check_interval the cache reads the current generations of all cached
+    wallets, batch_size wallets per query to stay within SQLite's limit of
+    bound variables, and drops the entries that fell behind.
+    """
+
+    def __init__(
+        self,
+        fetch_generations: FetchGenerations,
+        check_interval: float = 5.0,
+        max_size: int = 10000,
+        batch_size: int = 500,
+    ):
+        self.fetch_generations = fetch_generations
+        self.check_interval = check_interval
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self._entries: Dict[str, Tuple[Any, str, int]] = {}
+        self._last_check = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def put(self, key: str, value: Any, wallet: str, generation: int) -> None:
+        if key not in self._entries and len(self._entries) >= self.max_size:
+            # Evict the oldest entry.
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = (value, wallet, generation)
+
+    def invalidate_wallet(self, wallet: str) -> None:
+        for key in [k for k, entry in self._entries.items() if entry[1] == wallet]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    async def revalidate(self) -> None:
+        if time.monotonic() - self._last_check < self.check_interval:
+            return
+        async with self._lock:
+            if time.monotonic() - self._last_check < self.check_interval:
+                return
+            wallets = list({entry[1] for entry in self._entries.values()})
+            generations: Dict[str, int] = {}
+            for i in range(0, len(wallets), self.batch_size):
+                batch = wallets[i : i + self.batch_size]
+                generations.update(await self.fetch_generations(batch))
+            for key, (_, wallet, generation) in list(self._entries.items()):
+                if generations.get(wallet, 0) != generation:
+                    self._entries.pop(key, None)
+            self._last_check = time.monotonic()
@@ -1,11 +1,25 @@
+import json
 import secrets
 import time
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 from uuid import uuid4
 
+from lnbits.db import Connection
+
 from . import db
-from .helpers import generate_atmbitbit_lnurl_hash
-from .models import AtmBitBit, AtmBitBitLnurl, CreateAtmBitBit
+from .cache import GenerationCache
+from .events import atmbitbit_events
+from .helpers import generate_atmbitbit_lnurl_hash, generate_atmbitbit_lnurl_signature
+from .models import (
+    AtmBitBit,
+    AtmBitBitLnurl,
+    AtmBitBitWithdrawal,
+    AtmBitBitWithdrawalRollup,
+    CreateAtmBitBit,
+    ExchangeRateSample,
+    WebhookDelivery,
+    get_lnurl_use_shards,
+)
 
 
 async def create_atmbitbit(data: CreateAtmBitBit, wallet_id: str) -> AtmBitBit:
@@ -15,8 +29,8 @@ async def create_atmbitbit(data: CreateAtmBitBit, wallet_id: str) -> AtmBitBit:
     api_key_encoding = "hex"
     await db.execute(
         """
-        INSERT INTO atmbitbit.atmbitbits (id, wallet, api_key_id, api_key_secret, api_key_encoding, name, fiat_currency, exchange_rate_provider, fee)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO atmbitbit.atmbitbits (id, wallet, api_key_id, api_key_secret, api_key_encoding, name, fiat_currency, exchange_rate_provider, fee, max_rate_age, webhook_url)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
             atmbitbit_id,
@@ -28,10 +42,14 @@ async def create_atmbitbit(data: CreateAtmBitBit, wallet_id: str) -> AtmBitBit:
             data.fiat_currency,
             data.exchange_rate_provider,
             data.fee,
+            data.max_rate_age,
+            data.webhook_url,
         ),
     )
+    await bump_atmbitbit_generation(wallet_id)
     atmbitbit = await get_atmbitbit(atmbitbit_id)
     assert atmbitbit, "Newly created atmbitbit couldn't be retrieved"
+    atmbitbit_events.publish("atmbitbit.created", wallet_id, atmbitbit.dict())
     return atmbitbit
 
 
@@ -43,19 +61,49 @@ async def get_atmbitbit(atmbitbit_id: str) -> Optional[AtmBitBit]:
 
 
 async def get_atmbitbit_by_api_key_id(api_key_id: str) -> Optional[AtmBitBit]:
+    # Hot path of the /u endpoint, served from the cache when possible.
+    await atmbitbit_cache.revalidate()
+    atmbitbit = atmbitbit_cache.get(api_key_id)
+    if atmbitbit:
+        return atmbitbit
+    # Read the generation together with the row. Writers bump the generation
+    # after writing the row, so a stale row always comes with a stale generation.
     row = await db.fetchone(
-        "SELECT * FROM atmbitbit.atmbitbits WHERE api_key_id = ?", (api_key_id,)
+        """
+        SELECT a.*, g.generation FROM atmbitbit.atmbitbits a
+        LEFT JOIN atmbitbit.generations g ON g.wallet = a.wallet
+        WHERE a.api_key_id = ?
+        """,
+        (api_key_id,),
     )
-    return AtmBitBit(**row) if row else None
+    if not row:
+        return None
+    atmbitbit = AtmBitBit(**row)
+    atmbitbit_cache.put(api_key_id, atmbitbit, atmbitbit.wallet, row["generation"] or 0)
+    return atmbitbit
 
 
-async def get_atmbitbits(wallet_ids: Union[str, List[str]]) -> List[AtmBitBit]:
+async def get_atmbitbits(
+    wallet_ids: Union[str, List[str]],
+    limit: Optional[int] = None,
+    after: Optional[str] = None,
+) -> List[AtmBitBit]:
     if isinstance(wallet_ids, str):
         wallet_ids = [wallet_ids]
+    if not wallet_ids:
+        return []
     q = ",".join(["?"] * len(wallet_ids))
-    rows = await db.fetchall(
-        f"SELECT * FROM atmbitbit.atmbitbits WHERE wallet IN ({q})", (*wallet_ids,)
-    )
+    values: list = [*wallet_ids]
+    # Keyset pagination: pass the ID of the last row of a page as "after".
+    where = f"wallet IN ({q})"
+    if after is not None:
+        where += " AND id > ?"
+        values.append(after)
+    sql = f"SELECT * FROM atmbitbit.atmbitbits WHERE {where} ORDER BY id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        values.append(limit)
+    rows = await db.fetchall(sql, tuple(values))
     return [AtmBitBit(**row) for row in rows]
 
 
@@ -68,11 +116,49 @@ async def update_atmbitbit(atmbitbit_id: str, **kwargs) -> Optional[AtmBitBit]:
     row = await db.fetchone(
         "SELECT * FROM atmbitbit.atmbitbits WHERE id = ?", (atmbitbit_id,)
     )
-    return AtmBitBit(**row) if row else None
+    if not row:
+        return None
+    atmbitbit = AtmBitBit(**row)
+    await bump_atmbitbit_generation(atmbitbit.wallet)
+    atmbitbit_events.publish("atmbitbit.updated", atmbitbit.wallet, atmbitbit.dict())
+    return atmbitbit
 
 
 async def delete_atmbitbit(atmbitbit_id: str) -> None:
+    atmbitbit = await get_atmbitbit(atmbitbit_id)
     await db.execute("DELETE FROM atmbitbit.atmbitbits WHERE id = ?", (atmbitbit_id,))
+    if atmbitbit:
+        await bump_atmbitbit_generation(atmbitbit.wallet)
+        atmbitbit_events.publish(
+            "atmbitbit.deleted", atmbitbit.wallet, {"id": atmbitbit.id}
+        )
+
+
+async def bump_atmbitbit_generation(wallet_id: str) -> None:
+    # Every write to a wallet's ATMs increments that wallet's generation.
+    # Readers compare generations to tell whether their copy is still current.
+    atmbitbit_cache.invalidate_wallet(wallet_id)
+    await db.execute(
+        """
+        INSERT INTO atmbitbit.generations AS g (wallet, generation) VALUES (?, 1)
+        ON CONFLICT (wallet) DO UPDATE SET generation = g.generation + 1
+        """,
+        (wallet_id,),
+    )
+
+
+async def get_atmbitbit_generations(wallet_ids: List[str]) -> Dict[str, int]:
+    if not wallet_ids:
+        return {}
+    q = ",".join(["?"] * len(wallet_ids))
+    rows = await db.fetchall(
+        f"SELECT wallet, generation FROM atmbitbit.generations WHERE wallet IN ({q})",
+        (*wallet_ids,),
+    )
+    return {row["wallet"]: row["generation"] for row in rows}
+
+
+atmbitbit_cache = GenerationCache(get_atmbitbit_generations)
 
 
 async def create_atmbitbit_lnurl(
@@ -81,33 +167,304 @@ async def create_atmbitbit_lnurl(
     atmbitbit_lnurl_id = uuid4().hex
     hash = generate_atmbitbit_lnurl_hash(secret)
     now = int(time.time())
-    await db.execute(
+    async with db.connect() as conn:
+        await conn.execute(
+            """
+            INSERT INTO atmbitbit.atmbitbit_lnurls (id, atmbitbit, wallet, hash, tag, params, api_key_id, initial_uses, remaining_uses, created_time, updated_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                atmbitbit_lnurl_id,
+                atmbitbit.id,
+                atmbitbit.wallet,
+                hash,
+                tag,
+                params,
+                atmbitbit.api_key_id,
+                uses,
+                uses,
+                now,
+                now,
+            ),
+        )
+        # Uses of multi-use LNURLs are spread over counter rows (shards), so that
+        # concurrent redemptions don't all wait for the same row lock.
+        if uses > 1:
+            shards = get_lnurl_use_shards(uses)
+            for shard in range(shards):
+                await conn.execute(
+                    """
+                    INSERT INTO atmbitbit.lnurl_uses (lnurl, shard, remaining_uses)
+                    VALUES (?, ?, ?)
+                    """,
+                    (
+                        atmbitbit_lnurl_id,
+                        shard,
+                        uses // shards + (1 if shard < uses % shards else 0),
+                    ),
+                )
+    atmbitbit_lnurl = await get_atmbitbit_lnurl(secret)
+    assert atmbitbit_lnurl, "Newly created atmbitbit LNURL couldn't be retrieved"
+    return atmbitbit_lnurl
+
+
+# Multi-use LNURLs keep their remaining uses and the time of their last use in
+# their lnurl_uses shards.
+select_atmbitbit_lnurls = """
+    SELECT l.id, l.atmbitbit, l.wallet, l.hash, l.tag, l.params, l.api_key_id,
+        l.initial_uses,
+        COALESCE(
+            (
+                SELECT SUM(u.remaining_uses) FROM atmbitbit.lnurl_uses u
+                WHERE u.lnurl = l.id
+            ),
+            l.remaining_uses
+        ) AS remaining_uses,
+        l.created_time,
+        COALESCE(
+            (
+                SELECT MAX(u.updated_time) FROM atmbitbit.lnurl_uses u
+                WHERE u.lnurl = l.id
+            ),
+            l.updated_time
+        ) AS updated_time
+    FROM atmbitbit.atmbitbit_lnurls l
+"""
+
+
+async def get_atmbitbit_lnurl(secret: str) -> Optional[AtmBitBitLnurl]:
+    hash = generate_atmbitbit_lnurl_hash(secret)
+    row = await db.fetchone(f"{select_atmbitbit_lnurls} WHERE l.hash = ?", (hash,))
+    return AtmBitBitLnurl(**row) if row else None
+
+
+async def create_atmbitbit_withdrawal(
+    lnurl: AtmBitBitLnurl,
+    amount_msat: int,
+    payment_hash: Optional[str] = None,
+    conn: Optional[Connection] = None,
+) -> AtmBitBitWithdrawal:
+    # One row per paid withdrawal, with the fiat side of the amount paid.
+    params = json.loads(lnurl.params)
+    fiat_amount, fee_msat = lnurl.get_paid_fiat(amount_msat)
+    fiat = "fiatCurrency" in params
+    withdrawal = AtmBitBitWithdrawal(
+        id=uuid4().hex,
+        atmbitbit=lnurl.atmbitbit,
+        lnurl=lnurl.id,
+        payment_hash=payment_hash,
+        amount_msat=amount_msat,
+        fiat_currency=params.get("fiatCurrency"),
+        fiat_amount=fiat_amount if fiat else None,
+        exchange_rate=params.get("exchangeRate"),
+        fee_msat=fee_msat if fiat else None,
+        created_time=int(time.time()),
+    )
+    await (conn or db).execute(
         """
-        INSERT INTO atmbitbit.atmbitbit_lnurls (id, atmbitbit, wallet, hash, tag, params, api_key_id, initial_uses, remaining_uses, created_time, updated_time)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        INSERT INTO atmbitbit.withdrawals (id, atmbitbit, lnurl, payment_hash, amount_msat, fiat_currency, fiat_amount, exchange_rate, fee_msat, created_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
-            atmbitbit_lnurl_id,
+            withdrawal.id,
+            withdrawal.atmbitbit,
+            withdrawal.lnurl,
+            withdrawal.payment_hash,
+            withdrawal.amount_msat,
+            withdrawal.fiat_currency,
+            withdrawal.fiat_amount,
+            withdrawal.exchange_rate,
+            withdrawal.fee_msat,
+            withdrawal.created_time,
+        ),
+    )
+    return withdrawal
+
+
+async def get_atmbitbit_withdrawals(
+    atmbitbit_id: str,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    after: Optional[Tuple[int, str]] = None,
+    limit: int = 500,
+) -> List[AtmBitBitWithdrawal]:
+    # Paid withdrawals of the ATM, oldest first.
+    # Keyset pagination: pass (created_time, id) of the last row as "after".
+    where = "atmbitbit = ?"
+    values: list = [atmbitbit_id]
+    if since is not None:
+        where += " AND created_time >= ?"
+        values.append(since)
+    if until is not None:
+        where += " AND created_time < ?"
+        values.append(until)
+    if after is not None:
+        where += " AND (created_time > ? OR (created_time = ? AND id > ?))"
+        values.extend([after[0], after[0], after[1]])
+    rows = await db.fetchall(
+        f"""
+        SELECT * FROM atmbitbit.withdrawals
+        WHERE {where}
+        ORDER BY created_time, id
+        LIMIT ?
+        """,
+        (*values, limit),
+    )
+    return [AtmBitBitWithdrawal(**row) for row in rows]
+
+
+async def record_atmbitbit_withdrawal(
+    lnurl: AtmBitBitLnurl, amount_msat: int, conn: Optional[Connection] = None
+) -> None:
+    # Adds one paid withdrawal to the ATM's rollup for the current (UTC) day.
+    params = json.loads(lnurl.params)
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    # Withdrawals that were not denominated in fiat are rolled up under "".
+    fiat_currency = params.get("fiatCurrency", "")
+    fiat_amount, fee_msat = lnurl.get_paid_fiat(amount_msat)
+    await (conn or db).execute(
+        """
+        INSERT INTO atmbitbit.withdrawal_rollups AS r
+            (atmbitbit, day, fiat_currency, count, total_msat, total_fiat, total_fee_msat)
+        VALUES (?, ?, ?, 1, ?, ?, ?)
+        ON CONFLICT (atmbitbit, day, fiat_currency) DO UPDATE
+        SET count = r.count + 1,
+            total_msat = r.total_msat + excluded.total_msat,
+            total_fiat = r.total_fiat + excluded.total_fiat,
+            total_fee_msat = r.total_fee_msat + excluded.total_fee_msat
+        """,
+        (lnurl.atmbitbit, day, fiat_currency, amount_msat, fiat_amount, fee_msat),
+    )
+
+
+async def get_atmbitbit_withdrawal_rollups(
+    atmbitbit_id: str, start: Optional[str] = None, end: Optional[str] = None
+) -> List[AtmBitBitWithdrawalRollup]:
+    where = "atmbitbit = ?"
+    values = [atmbitbit_id]
+    if start:
+        where += " AND day >= ?"
+        values.append(start)
+    if end:
+        where += " AND day <= ?"
+        values.append(end)
+    rows = await db.fetchall(
+        f"""
+        SELECT * FROM atmbitbit.withdrawal_rollups
+        WHERE {where}
+        ORDER BY day, fiat_currency
+        """,
+        tuple(values),
+    )
+    return [AtmBitBitWithdrawalRollup(**row) for row in rows]
+
+
+async def create_exchange_rate_samples(
+    samples: List[ExchangeRateSample], interval: int
+) -> None:
+    # One transaction per batch. The first sample written for a pair in an
+    # interval is kept, also when several workers write the same interval.
+    async with db.connect() as conn:
+        for sample in samples:
+            await conn.execute(
+                """
+                INSERT INTO atmbitbit.exchange_rates (provider, currency, bucket, rate, fetched_time)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+                """,
+                (
+                    sample.provider,
+                    sample.currency,
+                    sample.fetched_time - sample.fetched_time % interval,
+                    sample.rate,
+                    sample.fetched_time,
+                ),
+            )
+
+
+async def delete_exchange_rate_samples(before: int) -> None:
+    await db.execute("DELETE FROM atmbitbit.exchange_rates WHERE bucket < ?", (before,))
+
+
+async def get_latest_exchange_rate_sample(
+    provider: str, currency: str, since: int
+) -> Optional[ExchangeRateSample]:
+    row = await db.fetchone(
+        """
+        SELECT provider, currency, rate, fetched_time FROM atmbitbit.exchange_rates
+        WHERE provider = ? AND currency = ? AND fetched_time >= ?
+        ORDER BY bucket DESC
+        LIMIT 1
+        """,
+        (provider, currency, since),
+    )
+    return ExchangeRateSample(**row) if row else None
+
+
+async def create_webhook_delivery(
+    atmbitbit: AtmBitBit, payload: str, conn: Optional[Connection] = None
+) -> None:
+    assert atmbitbit.webhook_url
+    now = int(time.time())
+    # Signed with the ATM's API key, so that the receiver can authenticate it.
+    signature = generate_atmbitbit_lnurl_signature(
+        payload, atmbitbit.api_key_secret, atmbitbit.api_key_encoding
+    )
+    await (conn or db).execute(
+        """
+        INSERT INTO atmbitbit.webhook_outbox (id, atmbitbit, url, payload, signature, next_attempt_time, created_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            uuid4().hex,
             atmbitbit.id,
-            atmbitbit.wallet,
-            hash,
-            tag,
-            params,
-            atmbitbit.api_key_id,
-            uses,
-            uses,
+            atmbitbit.webhook_url,
+            payload,
+            signature,
             now,
             now,
         ),
     )
-    atmbitbit_lnurl = await get_atmbitbit_lnurl(secret)
-    assert atmbitbit_lnurl, "Newly created atmbitbit LNURL couldn't be retrieved"
-    return atmbitbit_lnurl
 
 
-async def get_atmbitbit_lnurl(secret: str) -> Optional[AtmBitBitLnurl]:
-    hash = generate_atmbitbit_lnurl_hash(secret)
-    row = await db.fetchone(
-        "SELECT * FROM atmbitbit.atmbitbit_lnurls WHERE hash = ?", (hash,)
+async def get_due_webhook_deliveries(limit: int = 100) -> List[WebhookDelivery]:
+    # "sending" rows are due again when their claim's lease ran out, i.e. the
+    # process delivering them died.
+    rows = await db.fetchall(
+        """
+        SELECT * FROM atmbitbit.webhook_outbox
+        WHERE status IN ('pending', 'sending') AND next_attempt_time <= ?
+        ORDER BY next_attempt_time
+        LIMIT ?
+        """,
+        (int(time.time()), limit),
+    )
+    return [WebhookDelivery(**row) for row in rows]
+
+
+async def claim_webhook_delivery(delivery: WebhookDelivery, lease_until: int) -> bool:
+    # Every worker process runs a dispatcher. Only the one whose update still
+    # finds the row as it was read gets to deliver it.
+    result = await db.execute(
+        """
+        UPDATE atmbitbit.webhook_outbox
+        SET status = 'sending', next_attempt_time = ?
+        WHERE id = ? AND status = ? AND next_attempt_time = ?
+        """,
+        (lease_until, delivery.id, delivery.status, delivery.next_attempt_time),
+    )
+    return result.rowcount > 0
+
+
+async def update_webhook_delivery(delivery_id: str, **kwargs) -> None:
+    q = ", ".join([f"{field[0]} = ?" for field in kwargs.items()])
+    await db.execute(
+        f"UPDATE atmbitbit.webhook_outbox SET {q} WHERE id = ?",
+        (*kwargs.values(), delivery_id),
+    )
+
+
+async def delete_webhook_delivery(delivery_id: str) -> None:
+    await db.execute(
+        "DELETE FROM atmbitbit.webhook_outbox WHERE id = ?", (delivery_id,)
     )
-    return AtmBitBitLnurl(**row) if row else None
@@ -0,0 +1,79 @@
+import asyncio
+import secrets
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator, List, Optional, Set
+
+
+class AtmBitBitEvent:
+    def __init__(self, id: str, type: str, wallet: str, data: dict):
+        self.id = id
+        self.type = type
+        self.wallet = wallet
+        self.data = data
+
+
+class AtmBitBitEventSubscription:
+    def __init__(self, wallet_ids: List[str], queue_size: int):
+        self.wallet_ids = set(wallet_ids)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # Set when the subscriber fell too far behind. Its stream is then closed
+        # and the client catches up from the history when it reconnects.
+        self.overflowed = False
+
+
+class AtmBitBitEventBroadcaster:
+    def __init__(self, history_size: int = 1000, queue_size: int = 100):
+        # Event IDs are "<boot>:<sequence>" so that an ID from before a restart
+        # is never mistaken for one issued by this process.
+        self.boot = secrets.token_hex(4)
+        self.queue_size = queue_size
+        self._sequence = 0
+        self._history: Deque[AtmBitBitEvent] = deque(maxlen=history_size)
+        self._subscriptions: Set[AtmBitBitEventSubscription] = set()
+
+    def publish(self, type: str, wallet: str, data: dict) -> None:
+        # Never blocks: slow subscribers are cut off instead of slowing writers.
+        self._sequence += 1
+        event = AtmBitBitEvent(f"{self.boot}:{self._sequence}", type, wallet, data)
+        self._history.append(event)
+        for subscription in self._subscriptions:
+            if subscription.overflowed or wallet not in subscription.wallet_ids:
+                continue
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+
+    def replay(
+        self, last_event_id: str, wallet_ids: List[str]
+    ) -> Optional[List[AtmBitBitEvent]]:
+        # Events published after "last_event_id", or None when they are no
+        # longer (or were never) in the history and the client must resync.
+        boot, _, sequence = last_event_id.partition(":")
+        if boot != self.boot or not sequence.isdigit():
+            return None
+        last_sequence = int(sequence)
+        if last_sequence > self._sequence:
+            return None
+        oldest_sequence = self._sequence - len(self._history) + 1
+        if last_sequence + 1 < oldest_sequence:
+            return None
+        return [
+            event
+            for event in self._history
+            if int(event.id.partition(":")[2]) > last_sequence
+            and event.wallet in wallet_ids
+        ]
+
+    @contextmanager
+    def subscribe(self, wallet_ids: List[str]) -> Iterator[AtmBitBitEventSubscription]:
+        subscription = AtmBitBitEventSubscription(wallet_ids, self.queue_size)
+        self._subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            self._subscriptions.discard(subscription)
+
+
+atmbitbit_events = AtmBitBitEventBroadcaster()
@@ -1,20 +1,30 @@
+import asyncio
 import json
 import os
-from typing import Callable, Union
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 
 import httpx
+from loguru import logger
+from websockets import connect
 
-fiat_currencies = json.load(
-    open(
-        os.path.join(
-            os.path.dirname(os.path.realpath(__file__)), "fiat_currencies.json"
-        ),
-        "r",
-    )
+fiat_currencies_path = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "fiat_currencies.json"
 )
 
+
+@lru_cache(maxsize=None)
+def get_fiat_currencies() -> Dict[str, str]:
+    with open(fiat_currencies_path, "r") as f:
+        return json.load(f)
+
+
+# A provider can also have a "stream": a websocket ticker that keeps the last
+# price in memory. "subscribe" builds the subscription message and "getter"
+# returns the price from a received message, or None for other messages.
 exchange_rate_providers: dict[
-    str, dict[str, Union[str, Callable[[dict, dict], str]]]
+    str, dict[str, Union[str, dict, Callable[[dict, dict], str]]]
 ] = {
     "bitfinex": {
         "name": "Bitfinex",
@@ -27,6 +37,18 @@ exchange_rate_providers: dict[
         "domain": "bitstamp.net",
         "api_url": "https://www.bitstamp.net/api/v2/ticker/{from}{to}/",
         "getter": lambda data, replacements: data["last"],
+        "stream": {
+            "url": "wss://ws.bitstamp.net",
+            "subscribe": lambda replacements: {
+                "event": "bts:subscribe",
+                "data": {
+                    "channel": "live_trades_{from}{to}".format(**replacements)
+                },
+            },
+            "getter": lambda data, replacements: data["data"]["price"]
+            if data.get("event") == "trade"
+            else None,
+        },
     },
     "coinbase": {
         "name": "Coinbase",
@@ -47,27 +69,128 @@ exchange_rate_providers: dict[
         "getter": lambda data, replacements: data["result"][
             "XXBTZ" + replacements["TO"]
         ]["c"][0],
+        "stream": {
+            "url": "wss://ws.kraken.com",
+            "subscribe": lambda replacements: {
+                "event": "subscribe",
+                "pair": ["XBT/" + replacements["TO"]],
+                "subscription": {"name": "ticker"},
+            },
+            "getter": lambda data, replacements: data[1]["c"][0]
+            if isinstance(data, list) and data[2] == "ticker"
+            else None,
+        },
     },
 }
 
-exchange_rate_providers_serializable = {}
-for ref, exchange_rate_provider in exchange_rate_providers.items():
-    exchange_rate_provider_serializable = {}
-    for key, value in exchange_rate_provider.items():
-        if not callable(value):
-            exchange_rate_provider_serializable[key] = value
-    exchange_rate_providers_serializable[ref] = exchange_rate_provider_serializable
 
+def get_exchange_rate_providers_serializable() -> Dict[str, Dict[str, Any]]:
+    exchange_rate_providers_serializable = {}
+    for ref, exchange_rate_provider in exchange_rate_providers.items():
+        exchange_rate_provider_serializable = {}
+        for key, value in exchange_rate_provider.items():
+            if not callable(value) and key != "stream":
+                exchange_rate_provider_serializable[key] = value
+        exchange_rate_providers_serializable[ref] = exchange_rate_provider_serializable
+    return exchange_rate_providers_serializable
 
-async def fetch_fiat_exchange_rate(currency: str, provider: str):
 
-    replacements = {
+def get_replacements(currency: str) -> Dict[str, str]:
+    return {
         "FROM": "BTC",
         "from": "btc",
         "TO": currency.upper(),
         "to": currency.lower(),
     }
 
+
+class ExchangeRateStream:
+    """
+    Keeps the last price of a provider's websocket ticker in memory and
+    reconnects when the connection fails. The price is only handed out while
+    the stream has been heard from within max_silence seconds.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        currency: str,
+        max_silence: float = 30.0,
+        reconnect_delay: float = 1.0,
+        max_reconnect_delay: float = 60.0,
+    ):
+        self.provider = provider
+        self.currency = currency
+        self.max_silence = max_silence
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.price: Optional[float] = None
+        self.updated = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def get_price(self) -> Optional[float]:
+        if self.price is None or time.monotonic() - self.updated > self.max_silence:
+            return None
+        return self.price
+
+    def start(self) -> None:
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+
+    async def run(self) -> None:
+        stream: Any = exchange_rate_providers[self.provider]["stream"]
+        replacements = get_replacements(self.currency)
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async with connect(stream["url"]) as ws:
+                    await ws.send(json.dumps(stream["subscribe"](replacements)))
+                    async for message in ws:
+                        value = stream["getter"](json.loads(message), replacements)
+                        if value is not None:
+                            self.price = float(value)
+                            self.updated = time.monotonic()
+                            delay = self.reconnect_delay
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f'Exchange rate stream "{self.provider}" failed: {e}')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+
+exchange_rate_streams: Dict[Tuple[str, str], ExchangeRateStream] = {}
+
+
+def get_exchange_rate_stream(
+    currency: str, provider: str
+) -> Optional[ExchangeRateStream]:
+    # Streams are started the first time their pair is asked for.
+    if "stream" not in exchange_rate_providers[provider]:
+        return None
+    key = (provider, currency.upper())
+    if key not in exchange_rate_streams:
+        exchange_rate_streams[key] = ExchangeRateStream(provider, currency.upper())
+    stream = exchange_rate_streams[key]
+    stream.start()
+    return stream
+
+
+async def fetch_fiat_exchange_rate(currency: str, provider: str):
+
+    # Streaming providers answer from memory, unless the stream went quiet.
+    stream = get_exchange_rate_stream(currency, provider)
+    if stream:
+        price = stream.get_price()
+        if price is not None:
+            return price
+
+    replacements = get_replacements(currency)
+
     api_url_or_none = exchange_rate_providers[provider]["api_url"]
     if api_url_or_none is not None:
         api_url = str(api_url_or_none)
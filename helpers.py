@@ -1,8 +1,13 @@
+import asyncio
 import base64
 import hashlib
 import hmac
+import ipaddress
+import math
+import socket
+import zipfile
 from http import HTTPStatus
-from typing import Dict
+from typing import AsyncIterable, AsyncIterator, Dict, List, Tuple
 from urllib import parse
 
 from fastapi import Request
@@ -38,6 +43,98 @@ def get_callback_url(req: Request):
     return req.url_for("atmbitbit.api_atmbitbit_lnurl")
 
 
+config_file_field_to_key = {
+    "api_key_id": "apiKey.id",
+    "api_key_secret": "apiKey.key",
+    "api_key_encoding": "apiKey.encoding",
+    "fiat_currency": "fiatCurrency",
+}
+
+
+def generate_atmbitbit_config_file(atmbitbit: dict, callback_url: str) -> str:
+    # Same format as the "atmbitbit.conf" file exported by the dashboard.
+    lines = [
+        f"{key}={atmbitbit[field]}"
+        for field, key in config_file_field_to_key.items()
+        if field in atmbitbit
+    ]
+    lines.append(f"callbackUrl={callback_url}")
+    lines.append("shorten=true")
+    return "\n".join(lines)
+
+
+class _ZipStreamBuffer:
+    # Write-only, non-seekable file object. Because it has no tell(), zipfile
+    # falls back to data descriptors and never seeks back into the archive,
+    # so everything written so far can be handed out and forgotten.
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def stream_atmbitbit_config_zip(
+    atmbitbits: AsyncIterable[dict], callback_url: str
+) -> AsyncIterator[bytes]:
+    # One "<api_key_id>/atmbitbit.conf" entry per ATM, yielded as soon as it is
+    # compressed. Only the zip central directory grows with the fleet size.
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        async for atmbitbit in atmbitbits:
+            zf.writestr(
+                f"{atmbitbit['api_key_id']}/atmbitbit.conf",
+                generate_atmbitbit_config_file(atmbitbit, callback_url),
+            )
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    yield buffer.drain()
+
+
+webhook_host_not_public = (
+    "Webhook URL must not point to a private, loopback or link-local address"
+)
+
+
+def is_public_webhook_host(host: str) -> bool:
+    # Webhooks are posted from the LNbits host. Without resolving anything,
+    # rejects the names and IP addresses that would reach the host itself, its
+    # private network or link-local services (e.g. cloud metadata).
+    host = host.lower().rstrip(".")
+    if not host or host == "localhost" or host.endswith(".localhost"):
+        return False
+    try:
+        address = ipaddress.ip_address(host.split("%")[0])
+    except ValueError:
+        # A name: see check_webhook_url().
+        return True
+    return address.is_global
+
+
+async def check_webhook_url(url: str) -> None:
+    # Raises ValueError unless the URL's host only resolves to public addresses.
+    host = parse.urlparse(url).hostname or ""
+    if not is_public_webhook_host(host):
+        raise ValueError(webhook_host_not_public)
+    try:
+        addresses = await asyncio.get_event_loop().getaddrinfo(host, None)
+    except socket.gaierror as e:
+        raise ValueError(f'Failed to resolve webhook host "{host}": {e}')
+    for *_, sockaddr in addresses:
+        if not is_public_webhook_host(str(sockaddr[0])):
+            raise ValueError(webhook_host_not_public)
+
+
 def is_supported_lnurl_subprotocol(tag: str) -> bool:
     return tag == "withdrawRequest"
 
@@ -57,6 +154,21 @@ class LnurlValidationError(Exception):
     pass
 
 
+def fiat_to_msats(amount: float, rate: float, fee: float) -> Tuple[int, int]:
+    # Converts a fiat amount to msats less the fee (a decimal, e.g. 0.01 for 1%).
+    # Returns the amount and the fee, both in msats.
+    amount_sats = int(math.floor((amount / rate) * 1e8))
+    fee_sats = int(math.floor(amount_sats * fee))
+    amount_sats_less_fee = amount_sats - fee_sats
+    return int(amount_sats_less_fee * 1e3), int(fee_sats * 1e3)
+
+
+def fiat_amounts_to_msats(
+    amounts: List[float], rate: float, fee: float
+) -> List[Tuple[int, int]]:
+    return [fiat_to_msats(amount, rate, fee) for amount in amounts]
+
+
 def prepare_lnurl_params(tag: str, query: dict) -> dict:
     params: dict = {}
     if not is_supported_lnurl_subprotocol(tag):
@@ -114,26 +226,32 @@ unshorten_rules: dict[str, dict] = {
 }
 
 
-def unshorten_lnurl_query(query: dict) -> Dict[str, str]:
+def unshorten_lnurl_query(query: dict, require_tag: bool = True) -> Dict[str, str]:
+    # Queries without a tag (e.g. quotes) only get their general keys unshortened.
     new_query = {}
     rules = unshorten_rules
+    param_rules: Dict[str, str] = {}
     if "tag" in query:
         tag = query["tag"]
     elif "t" in query:
         tag = query["t"]
+    elif not require_tag:
+        tag = None
     else:
         raise LnurlValidationError('Missing required query parameter: "tag"')
-    # Unshorten tag:
-    if tag in rules["tags"]:
-        long_tag = rules["tags"][tag]
-        new_query["tag"] = long_tag
-        tag = long_tag
-    if tag not in rules["params"]:
-        raise LnurlValidationError(f'Unknown tag: "{tag}"')
+    if tag is not None:
+        # Unshorten tag:
+        if tag in rules["tags"]:
+            long_tag = rules["tags"][tag]
+            new_query["tag"] = long_tag
+            tag = long_tag
+        if tag not in rules["params"]:
+            raise LnurlValidationError(f'Unknown tag: "{tag}"')
+        param_rules = rules["params"][str(tag)]
     for key in query:
-        if key in rules["params"][str(tag)]:
+        if key in param_rules:
             short_param_key = key
-            long_param_key = rules["params"][str(tag)][short_param_key]
+            long_param_key = param_rules[short_param_key]
             if short_param_key in query:
                 new_query[long_param_key] = query[short_param_key]
             else:
@@ -0,0 +1,104 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from lnbits.core.crud import get_wallet
+
+
+class WalletLiquidity:
+    """
+    Cached balances of the ATM wallets, less the maxWithdrawable of LNURLs that
+    were handed out but not paid yet (reservations). Balances are refreshed in
+    the background, so checking a withdrawal against them costs no I/O. Only
+    wallets with reservations or looked up within idle_ttl seconds are kept
+    and refreshed.
+
+    Reservations live in this process. With several workers, each one can
+    hand out the same balance, so the guarantee holds for a single worker.
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float = 10.0,
+        max_balance_age: float = 60.0,
+        reservation_ttl: float = 600.0,
+        idle_ttl: float = 300.0,
+    ):
+        self.refresh_interval = refresh_interval
+        self.max_balance_age = max_balance_age
+        self.reservation_ttl = reservation_ttl
+        self.idle_ttl = idle_ttl
+        self._balances: Dict[str, Tuple[int, float]] = {}
+        self._reservations: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        self._last_lookup: Dict[str, float] = {}
+
+    async def refresh(self, wallet_ids: Optional[List[str]] = None) -> None:
+        if wallet_ids is None:
+            wallet_ids = self.evict_idle()
+        for wallet_id in wallet_ids:
+            wallet = await get_wallet(wallet_id)
+            if wallet:
+                self._balances[wallet_id] = (wallet.balance_msat, time.monotonic())
+            else:
+                self.evict(wallet_id)
+
+    def evict_idle(self) -> List[str]:
+        # Returns the wallets that are still in use.
+        now = time.monotonic()
+        active = []
+        for wallet_id in list(self._balances.keys()):
+            recent = now - self._last_lookup.get(wallet_id, 0) < self.idle_ttl
+            if recent or self.reserved(wallet_id):
+                active.append(wallet_id)
+            else:
+                self.evict(wallet_id)
+        return active
+
+    def evict(self, wallet_id: str) -> None:
+        self._balances.pop(wallet_id, None)
+        self._reservations.pop(wallet_id, None)
+        self._last_lookup.pop(wallet_id, None)
+
+    def reserved(self, wallet_id: str) -> float:
+        reservations = self._reservations.get(wallet_id, {})
+        now = time.monotonic()
+        # Unpaid LNURLs stop holding funds after reservation_ttl.
+        for key in [k for k, (_, expires) in reservations.items() if expires < now]:
+            del reservations[key]
+        return sum(amount for amount, _ in reservations.values())
+
+    async def get_available(self, wallet_id: str) -> float:
+        self._last_lookup[wallet_id] = time.monotonic()
+        entry = self._balances.get(wallet_id)
+        if not entry or time.monotonic() - entry[1] > self.max_balance_age:
+            await self.refresh([wallet_id])
+            entry = self._balances.get(wallet_id)
+            if not entry:
+                return 0
+        return entry[0] - self.reserved(wallet_id)
+
+    async def try_reserve(self, wallet_id: str, key: str, amount_msat: float) -> bool:
+        # Only the balance refresh awaits. The check and the reservation run
+        # without yielding, so concurrent requests can't pass on the same funds.
+        available = await self.get_available(wallet_id)
+        if amount_msat > available:
+            return False
+        self.reserve(wallet_id, key, amount_msat)
+        return True
+
+    def reserve(self, wallet_id: str, key: str, amount_msat: float) -> None:
+        expires = time.monotonic() + self.reservation_ttl
+        self._reservations.setdefault(wallet_id, {})[key] = (amount_msat, expires)
+
+    def release(self, wallet_id: str, key: str) -> None:
+        self._reservations.get(wallet_id, {}).pop(key, None)
+
+    def settle(self, wallet_id: str, key: str, paid_msat: int) -> None:
+        # The withdrawal was paid: drop its reservation and take the payment
+        # off the cached balance until the next refresh.
+        self.release(wallet_id, key)
+        entry = self._balances.get(wallet_id)
+        if entry:
+            self._balances[wallet_id] = (entry[0] - paid_msat, entry[1])
+
+
+wallet_liquidity = WalletLiquidity()
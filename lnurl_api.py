@@ -1,31 +1,124 @@
 import json
 import math
+import time
+from functools import partial
 from http import HTTPStatus
+from typing import List, Optional
 
 from loguru import logger
 from starlette.requests import Request
 
+from lnbits import bolt11
+
 from . import atmbitbit_ext
+from .admission import (
+    PRIORITY_CALLBACK,
+    PRIORITY_CREATE,
+    AdmissionShed,
+    admission_controller,
+)
+from .audit import audit_log
 from .crud import (
     create_atmbitbit_lnurl,
+    create_atmbitbit_withdrawal,
+    create_webhook_delivery,
     get_atmbitbit_by_api_key_id,
     get_atmbitbit_lnurl,
+    record_atmbitbit_withdrawal,
 )
-from .exchange_rates import fetch_fiat_exchange_rate
 from .helpers import (
     LnurlHttpError,
     LnurlValidationError,
+    fiat_amounts_to_msats,
+    fiat_to_msats,
+    generate_atmbitbit_lnurl_hash,
     generate_atmbitbit_lnurl_secret,
     generate_atmbitbit_lnurl_signature,
     prepare_lnurl_params,
     query_to_signing_payload,
     unshorten_lnurl_query,
 )
+from .liquidity import wallet_liquidity
+from .models import AtmBitBit, AtmBitBitLnurl
+from .rate_history import exchange_rate_history, get_fiat_exchange_rate
+from .traffic import traffic_recorder
+from .webhooks import webhook_dispatcher
+
+
+async def verify_signed_query(query: dict, required_fields: List[str]) -> AtmBitBit:
+    # Use signature to verify that the URL was generated by an authorized device.
+    signature = query["signature"]
+
+    # The API key ID, nonce, and the other required fields should be present in the query string.
+    for field in required_fields:
+        if field not in query:
+            raise LnurlHttpError(
+                f'Failed API key signature check: Missing "{field}"',
+                HTTPStatus.BAD_REQUEST,
+            )
+
+    # URL signing scheme is described here:
+    # https://github.com/chill117/lnurl-node#how-to-implement-url-signing-scheme
+    payload = query_to_signing_payload(query)
+    api_key_id = query["id"]
+    atmbitbit = await get_atmbitbit_by_api_key_id(api_key_id)
+    if not atmbitbit:
+        raise LnurlHttpError("Unknown API key", HTTPStatus.BAD_REQUEST)
+    api_key_secret = atmbitbit.api_key_secret
+    api_key_encoding = atmbitbit.api_key_encoding
+    expected_signature = generate_atmbitbit_lnurl_signature(
+        payload, api_key_secret, api_key_encoding
+    )
+    if signature != expected_signature:
+        raise LnurlHttpError("Invalid API key signature", HTTPStatus.FORBIDDEN)
+    return atmbitbit
+
+
+async def record_withdrawal(
+    atmbitbit: Optional[AtmBitBit],
+    lnurl: AtmBitBitLnurl,
+    conn,
+    invoice: bolt11.Invoice,
+) -> None:
+    # Runs in the transaction that takes the LNURL's use and pays the invoice,
+    # so the webhook is queued exactly when the withdrawal is paid.
+    withdrawal = await create_atmbitbit_withdrawal(
+        lnurl, invoice.amount_msat, invoice.payment_hash, conn=conn
+    )
+    await record_atmbitbit_withdrawal(lnurl, invoice.amount_msat, conn=conn)
+    if atmbitbit and atmbitbit.webhook_url:
+        payload = {"event": "withdrawal.succeeded", **withdrawal.dict()}
+        await create_webhook_delivery(atmbitbit, json.dumps(payload), conn=conn)
 
 
 # Handles signed URL from AtmBitBit ATMs and "action" callback of auto-generated LNURLs.
 @atmbitbit_ext.get("/u", name="atmbitbit.api_atmbitbit_lnurl")
 async def api_atmbitbit_lnurl(req: Request):
+    # Callbacks complete withdrawals that customers already accepted, so under
+    # overload they are admitted before signed URLs that would create new ones.
+    if "signature" in req.query_params or "s" in req.query_params:
+        priority = PRIORITY_CREATE
+    else:
+        priority = PRIORITY_CALLBACK
+    started = time.time()
+    try:
+        # The slot is held until the response, i.e. also while a callback pays
+        # the invoice: max_concurrent caps concurrent payments as well.
+        async with admission_controller.admit(priority):
+            response = await handle_atmbitbit_lnurl(req)
+    except AdmissionShed:
+        response = {"status": "ERROR", "reason": "Service busy, please try again"}
+    if traffic_recorder:
+        try:
+            traffic_recorder.record(
+                dict(req.query_params), started, time.time() - started, response
+            )
+        except Exception as e:
+            logger.error(f"Failed to record /u request: {e}")
+    return response
+
+
+async def handle_atmbitbit_lnurl(req: Request):
     try:
         query = dict(req.query_params)
 
@@ -39,29 +132,8 @@ async def api_atmbitbit_lnurl(req: Request):
             # Use signature to verify that the URL was generated by an authorized device.
             # Later validate parameters, auto-generate LNURL, reply with LNURL response object.
             signature = query["signature"]
-
-            # The API key ID, nonce, and tag should be present in the query string.
-            for field in ["id", "nonce", "tag"]:
-                if field not in query:
-                    raise LnurlHttpError(
-                        f'Failed API key signature check: Missing "{field}"',
-                        HTTPStatus.BAD_REQUEST,
-                    )
-
-            # URL signing scheme is described here:
-            # https://github.com/chill117/lnurl-node#how-to-implement-url-signing-scheme
-            payload = query_to_signing_payload(query)
-            api_key_id = query["id"]
-            atmbitbit = await get_atmbitbit_by_api_key_id(api_key_id)
-            if not atmbitbit:
-                raise LnurlHttpError("Unknown API key", HTTPStatus.BAD_REQUEST)
-            api_key_secret = atmbitbit.api_key_secret
-            api_key_encoding = atmbitbit.api_key_encoding
-            expected_signature = generate_atmbitbit_lnurl_signature(
-                payload, api_key_secret, api_key_encoding
-            )
-            if signature != expected_signature:
-                raise LnurlHttpError("Invalid API key signature", HTTPStatus.FORBIDDEN)
+            atmbitbit = await verify_signed_query(query, ["id", "nonce", "tag"])
+            api_key_id = atmbitbit.api_key_id
 
             # Signature is valid.
             # In the case of signed URLs, the secret is deterministic based on the API key ID and signature.
@@ -72,32 +144,55 @@ async def api_atmbitbit_lnurl(req: Request):
                     tag = query["tag"]
                     params = prepare_lnurl_params(tag, query)
                     if "f" in query:
-                        rate = await fetch_fiat_exchange_rate(
+                        exchange_rate = await get_fiat_exchange_rate(
                             currency=query["f"],
                             provider=atmbitbit.exchange_rate_provider,
+                            max_age=atmbitbit.max_rate_age,
                         )
+                        rate = exchange_rate.rate
                         # Convert fee (%) to decimal:
                         fee = float(atmbitbit.fee) / 100
                         if tag == "withdrawRequest":
+                            # Keep the fiat side of the withdrawal for reporting.
+                            params["fiatCurrency"] = query["f"]
+                            params["fiatAmount"] = params["maxWithdrawable"]
+                            params["exchangeRate"] = rate
+                            params["exchangeRateProvider"] = exchange_rate.provider
+                            params["exchangeRateTime"] = exchange_rate.fetched_time
                             for key in ["minWithdrawable", "maxWithdrawable"]:
-                                amount_sats = int(
-                                    math.floor((params[key] / rate) * 1e8)
+                                params[key], fee_msats = fiat_to_msats(
+                                    params[key], rate, fee
                                 )
-                                fee_sats = int(math.floor(amount_sats * fee))
-                                amount_sats_less_fee = amount_sats - fee_sats
-                                # Convert to msats:
-                                params[key] = int(amount_sats_less_fee * 1e3)
+                            params["feeMsat"] = fee_msats
                 except LnurlValidationError as e:
                     raise LnurlHttpError(str(e), HTTPStatus.BAD_REQUEST)
+                # Don't hand out withdrawals the ATM's wallet can't pay.
+                # Reservations are keyed by the LNURL's hash, known before insert.
+                hash = generate_atmbitbit_lnurl_hash(secret)
+                if tag == "withdrawRequest":
+                    if not await wallet_liquidity.try_reserve(
+                        atmbitbit.wallet, hash, params["maxWithdrawable"]
+                    ):
+                        raise LnurlHttpError(
+                            "Insufficient liquidity", HTTPStatus.SERVICE_UNAVAILABLE
+                        )
                 # Create a new LNURL using the query parameters provided in the signed URL.
                 json_params = json.JSONEncoder().encode(params)
-                lnurl = await create_atmbitbit_lnurl(
-                    atmbitbit=atmbitbit,
-                    secret=secret,
-                    tag=tag,
-                    params=json_params,
-                    uses=1,
-                )
+                try:
+                    lnurl = await create_atmbitbit_lnurl(
+                        atmbitbit=atmbitbit,
+                        secret=secret,
+                        tag=tag,
+                        params=json_params,
+                        uses=1,
+                    )
+                except Exception:
+                    # Keep the reservation if a concurrent request for the same
+                    # signed URL created the LNURL first.
+                    if not await get_atmbitbit_lnurl(secret):
+                        wallet_liquidity.release(atmbitbit.wallet, hash)
+                    raise
+                audit_log.log("lnurl_created", atmbitbit.id, lnurl.id, params=params)
 
             # Reply with LNURL response object.
             return lnurl.get_info_response_object(secret, req)
@@ -113,16 +208,27 @@ async def api_atmbitbit_lnurl(req: Request):
         if not lnurl:
             raise LnurlHttpError("Invalid secret", HTTPStatus.BAD_REQUEST)
 
+        audit_log.log("callback", lnurl.atmbitbit, lnurl.id)
+
         if not lnurl.has_uses_remaining():
             raise LnurlHttpError(
                 "Maximum number of uses already reached", HTTPStatus.BAD_REQUEST
             )
 
+        # Looked up before the transaction, which holds the database on SQLite.
+        atmbitbit = await get_atmbitbit_by_api_key_id(lnurl.api_key_id)
         try:
-            await lnurl.execute_action(query)
+            invoice = await lnurl.execute_action(
+                query, partial(record_withdrawal, atmbitbit, lnurl)
+            )
         except LnurlValidationError as e:
             raise LnurlHttpError(str(e), HTTPStatus.BAD_REQUEST)
 
+        if invoice:
+            wallet_liquidity.settle(lnurl.wallet, lnurl.hash, invoice.amount_msat)
+            if atmbitbit and atmbitbit.webhook_url:
+                webhook_dispatcher.notify()
+
     except LnurlHttpError as e:
         return {"status": "ERROR", "reason": str(e)}
     except Exception as e:
@@ -130,3 +236,64 @@ async def api_atmbitbit_lnurl(req: Request):
         return {"status": "ERROR", "reason": "Unexpected error"}
 
     return {"status": "OK"}
+
+
+# Seconds a fetched exchange rate is reused for quotes.
+quote_rate_max_age = 10
+
+
+# Fiat to msats quotes for a list of amounts, e.g. an ATM's denominations.
+# Signed with the ATM's API key in the same way as withdraw URLs.
+@atmbitbit_ext.get("/api/v1/quote", name="atmbitbit.api_atmbitbit_quote")
+async def api_atmbitbit_quote(req: Request):
+    try:
+        query = dict(req.query_params)
+        # Unshorten query if "s" is used instead of "signature".
+        if "s" in query:
+            query = unshorten_lnurl_query(query, require_tag=False)
+        if "signature" not in query:
+            raise LnurlHttpError("Missing signature", HTTPStatus.BAD_REQUEST)
+        atmbitbit = await verify_signed_query(query, ["id", "nonce", "f", "amounts"])
+        try:
+            amounts = [float(amount) for amount in query["amounts"].split(",")]
+        except ValueError:
+            amounts = []
+        if not amounts or not all(
+            math.isfinite(amount) and amount > 0 for amount in amounts
+        ):
+            raise LnurlHttpError(
+                'Invalid parameter ("amounts")', HTTPStatus.BAD_REQUEST
+            )
+        if len(amounts) > 100:
+            raise LnurlHttpError("Too many amounts", HTTPStatus.BAD_REQUEST)
+        # One rate lookup for the whole list. Quotes are only indicative, so a
+        # rate any worker fetched within quote_rate_max_age seconds will do,
+        # without calling the provider for every quote.
+        exchange_rate = await exchange_rate_history.get_latest(
+            atmbitbit.exchange_rate_provider, query["f"], quote_rate_max_age
+        )
+        if not exchange_rate:
+            exchange_rate = await get_fiat_exchange_rate(
+                currency=query["f"],
+                provider=atmbitbit.exchange_rate_provider,
+                max_age=atmbitbit.max_rate_age,
+            )
+        # Convert fee (%) to decimal:
+        fee = float(atmbitbit.fee) / 100
+        msats = fiat_amounts_to_msats(amounts, exchange_rate.rate, fee)
+    except LnurlHttpError as e:
+        return {"status": "ERROR", "reason": str(e)}
+    except Exception as e:
+        logger.error(str(e))
+        return {"status": "ERROR", "reason": "Unexpected error"}
+
+    return {
+        "status": "OK",
+        "fiatCurrency": query["f"],
+        "exchangeRate": exchange_rate.rate,
+        "exchangeRateTime": exchange_rate.fetched_time,
+        "quotes": [
+            {"amount": amount, "msats": amount_msats, "feeMsat": fee_msats}
+            for amount, (amount_msats, fee_msats) in zip(amounts, msats)
+        ],
+    }
@@ -1,3 +1,8 @@
+import json
+
+from lnbits.db import SQLITE
+
+
 async def m001_initial(db):
 
     await db.execute(
@@ -35,3 +40,260 @@ async def m001_initial(db):
         );
     """
     )
+
+
+async def m002_wallet_index_and_generations(db):
+
+    if db.type == SQLITE:
+        await db.execute(
+            "CREATE INDEX atmbitbit.atmbitbits_wallet_idx ON atmbitbits (wallet);"
+        )
+    else:
+        await db.execute(
+            "CREATE INDEX atmbitbits_wallet_idx ON atmbitbit.atmbitbits (wallet);"
+        )
+
+    await db.execute(
+        """
+        CREATE TABLE atmbitbit.generations (
+            wallet TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0
+        );
+    """
+    )
+
+
+async def m003_withdrawal_rollups(db):
+
+    await db.execute(
+        f"""
+        CREATE TABLE atmbitbit.withdrawal_rollups (
+            atmbitbit TEXT NOT NULL,
+            day TEXT NOT NULL,
+            fiat_currency TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            total_msat {db.big_int} NOT NULL DEFAULT 0,
+            total_fiat DOUBLE PRECISION NOT NULL DEFAULT 0,
+            total_fee_msat {db.big_int} NOT NULL DEFAULT 0,
+            PRIMARY KEY (atmbitbit, day, fiat_currency)
+        );
+    """
+    )
+
+
+async def m004_lnurls_created_time_index(db):
+
+    if db.type == SQLITE:
+        await db.execute(
+            """
+            CREATE INDEX atmbitbit.atmbitbit_lnurls_atmbitbit_created_idx
+            ON atmbitbit_lnurls (atmbitbit, created_time);
+            """
+        )
+    else:
+        await db.execute(
+            """
+            CREATE INDEX atmbitbit_lnurls_atmbitbit_created_idx
+            ON atmbitbit.atmbitbit_lnurls (atmbitbit, created_time);
+            """
+        )
+
+
+async def m005_exchange_rate_history(db):
+
+    await db.execute(
+        """
+        CREATE TABLE atmbitbit.exchange_rates (
+            provider TEXT NOT NULL,
+            currency TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            rate DOUBLE PRECISION NOT NULL,
+            fetched_time INTEGER NOT NULL,
+            PRIMARY KEY (provider, currency, bucket)
+        );
+    """
+    )
+
+    await db.execute(
+        """
+        ALTER TABLE atmbitbit.atmbitbits
+        ADD COLUMN max_rate_age INTEGER NOT NULL DEFAULT 0;
+    """
+    )
+
+
+async def m006_audit_log(db):
+
+    await db.execute(
+        f"""
+        CREATE TABLE atmbitbit.audit_log (
+            id {db.serial_primary_key},
+            time INTEGER NOT NULL,
+            atmbitbit TEXT NOT NULL,
+            lnurl TEXT,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+    """
+    )
+
+
+async def m007_webhooks(db):
+
+    await db.execute("ALTER TABLE atmbitbit.atmbitbits ADD COLUMN webhook_url TEXT;")
+
+    await db.execute(
+        """
+        CREATE TABLE atmbitbit.webhook_outbox (
+            id TEXT PRIMARY KEY,
+            atmbitbit TEXT NOT NULL,
+            url TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_time INTEGER NOT NULL,
+            created_time INTEGER NOT NULL
+        );
+    """
+    )
+
+
+async def m008_lnurl_use_shards(db):
+
+    await db.execute(
+        """
+        CREATE TABLE atmbitbit.lnurl_uses (
+            lnurl TEXT NOT NULL,
+            shard INTEGER NOT NULL,
+            remaining_uses INTEGER NOT NULL,
+            PRIMARY KEY (lnurl, shard)
+        );
+    """
+    )
+
+    # Give existing multi-use LNURLs a single shard holding their remaining uses.
+    await db.execute(
+        """
+        INSERT INTO atmbitbit.lnurl_uses (lnurl, shard, remaining_uses)
+        SELECT id, 0, remaining_uses FROM atmbitbit.atmbitbit_lnurls
+        WHERE initial_uses > 1
+    """
+    )
+
+
+async def m009_withdrawals(db):
+
+    await db.execute(
+        f"""
+        CREATE TABLE atmbitbit.withdrawals (
+            id TEXT PRIMARY KEY,
+            atmbitbit TEXT NOT NULL,
+            lnurl TEXT NOT NULL,
+            payment_hash TEXT,
+            amount_msat {db.big_int} NOT NULL,
+            fiat_currency TEXT,
+            fiat_amount DOUBLE PRECISION,
+            exchange_rate DOUBLE PRECISION,
+            fee_msat {db.big_int},
+            created_time INTEGER NOT NULL
+        );
+    """
+    )
+
+    if db.type == SQLITE:
+        await db.execute(
+            """
+            CREATE INDEX atmbitbit.withdrawals_atmbitbit_created_idx
+            ON withdrawals (atmbitbit, created_time);
+            """
+        )
+    else:
+        await db.execute(
+            """
+            CREATE INDEX withdrawals_atmbitbit_created_idx
+            ON atmbitbit.withdrawals (atmbitbit, created_time);
+            """
+        )
+
+    # Withdrawals paid before this migration only left their LNURL's use count.
+    # Record one row per use, at maxWithdrawable and the LNURL's last update.
+    rows = await db.fetchall(
+        """
+        SELECT * FROM (
+            SELECT l.id, l.atmbitbit, l.params, l.initial_uses, l.updated_time,
+                COALESCE(
+                    (
+                        SELECT SUM(u.remaining_uses) FROM atmbitbit.lnurl_uses u
+                        WHERE u.lnurl = l.id
+                    ),
+                    l.remaining_uses
+                ) AS remaining_uses
+            FROM atmbitbit.atmbitbit_lnurls l
+        ) AS lnurls
+        WHERE remaining_uses < initial_uses
+        """
+    )
+    for row in rows:
+        params = json.loads(row["params"])
+        for use in range(row["initial_uses"] - row["remaining_uses"]):
+            await db.execute(
+                """
+                INSERT INTO atmbitbit.withdrawals (id, atmbitbit, lnurl, amount_msat, fiat_currency, fiat_amount, exchange_rate, fee_msat, created_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    f"{row['id']}-{use}",
+                    row["atmbitbit"],
+                    row["id"],
+                    int(params.get("maxWithdrawable", 0)),
+                    params.get("fiatCurrency"),
+                    params.get("fiatAmount"),
+                    params.get("exchangeRate"),
+                    params.get("feeMsat"),
+                    row["updated_time"],
+                ),
+            )
+
+
+async def m010_lnurl_use_shards_updated_time(db):
+
+    # Redemptions of multi-use LNURLs only write their shard, so the LNURL's
+    # updated_time is the latest of its shards' (NULL until first used).
+    await db.execute(
+        "ALTER TABLE atmbitbit.lnurl_uses ADD COLUMN updated_time INTEGER;"
+    )
+
+
+async def m011_drop_lnurls_created_time_index(db):
+
+    # The withdrawals export reads the withdrawals table now, nothing else
+    # looked LNURLs up by ATM and creation time.
+    await db.execute(
+        "DROP INDEX IF EXISTS atmbitbit.atmbitbit_lnurls_atmbitbit_created_idx;"
+    )
+
+
+async def m012_webhook_signatures(db):
+
+    await db.execute("ALTER TABLE atmbitbit.webhook_outbox ADD COLUMN signature TEXT;")
+
+
+async def m013_wallet_id_index(db):
+
+    # The listing filters by wallet and pages through the IDs in order.
+    await db.execute("DROP INDEX IF EXISTS atmbitbit.atmbitbits_wallet_idx;")
+    if db.type == SQLITE:
+        await db.execute(
+            """
+            CREATE INDEX atmbitbit.atmbitbits_wallet_id_idx
+            ON atmbitbits (wallet, id);
+            """
+        )
+    else:
+        await db.execute(
+            """
+            CREATE INDEX atmbitbits_wallet_id_idx
+            ON atmbitbit.atmbitbits (wallet, id);
+            """
+        )
@@ -1,6 +1,8 @@
 import json
+import random
 import time
-from typing import Dict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
 from fastapi import Query, Request
 from loguru import logger
@@ -10,8 +12,19 @@ from lnbits import bolt11
 from lnbits.core.services import PaymentFailure, pay_invoice
 
 from . import db
-from .exchange_rates import exchange_rate_providers, fiat_currencies
-from .helpers import LnurlValidationError, get_callback_url
+from .audit import audit_log
+from .events import atmbitbit_events
+from .exchange_rates import exchange_rate_providers, get_fiat_currencies
+from .helpers import (
+    LnurlValidationError,
+    get_callback_url,
+    is_public_webhook_host,
+    webhook_host_not_public,
+)
+from .liquidity import wallet_liquidity
+
+# Called with the open transaction and the invoice before it is paid.
+RecordWithdrawal = Callable[[Any, bolt11.Invoice], Awaitable[Any]]
 
 
 class CreateAtmBitBit(BaseModel):
@@ -19,10 +32,13 @@ class CreateAtmBitBit(BaseModel):
     fiat_currency: str = Query(...)
     exchange_rate_provider: str = Query(...)
     fee: str = Query(...)
+    # Seconds a previously fetched rate may be used when the provider fails.
+    max_rate_age: int = Query(0)
+    webhook_url: Optional[str] = Query(None)
 
     @validator("fiat_currency")
     def allowed_fiat_currencies(cls, v):
-        if v not in fiat_currencies.keys():
+        if v not in get_fiat_currencies():
             raise ValueError("Not allowed currency")
         return v
 
@@ -38,6 +54,22 @@ class CreateAtmBitBit(BaseModel):
             raise ValueError("Fee type not allowed")
         return v
 
+    @validator("webhook_url")
+    def webhook_url_is_http(cls, v):
+        if not v:
+            return None
+        if not v.startswith(("http://", "https://")):
+            raise ValueError("Webhook URL must start with http:// or https://")
+        if not is_public_webhook_host(urlparse(v).hostname or ""):
+            raise ValueError(webhook_host_not_public)
+        return v
+
+    @validator("max_rate_age")
+    def max_rate_age_not_negative(cls, v):
+        if v < 0:
+            raise ValueError("Maximum exchange rate age must not be negative")
+        return v
+
 
 class AtmBitBit(BaseModel):
     id: str
@@ -49,6 +81,8 @@ class AtmBitBit(BaseModel):
     fiat_currency: str
     exchange_rate_provider: str
     fee: str
+    max_rate_age: int
+    webhook_url: Optional[str]
 
 
 class AtmBitBitLnurl(BaseModel):
@@ -79,7 +113,7 @@ class AtmBitBitLnurl(BaseModel):
             response["k1"] = secret
         return response
 
-    def validate_action(self, query) -> None:
+    def validate_action(self, query) -> Optional[bolt11.Invoice]:
         tag = self.tag
         params = json.loads(self.params)
         # Perform tag-specific checks.
@@ -105,31 +139,108 @@ class AtmBitBitLnurl(BaseModel):
                 raise LnurlValidationError(
                     'Amount in invoice must be less than or equal to "maxWithdrawable"'
                 )
+            return invoice
         else:
             raise LnurlValidationError(f'Unknown subprotocol: "{tag}"')
 
-    async def execute_action(self, query):
-        self.validate_action(query)
-        used = False
-        async with db.connect() as conn:
-            if self.initial_uses > 0:
-                used = await self.use(conn)
-                if not used:
-                    raise LnurlValidationError("Maximum number of uses already reached")
-            tag = self.tag
-            if tag == "withdrawRequest":
-                try:
-                    await pay_invoice(
-                        wallet_id=self.wallet, payment_request=query["pr"]
+    async def execute_action(
+        self, query, record: Optional[RecordWithdrawal] = None
+    ) -> Optional[bolt11.Invoice]:
+        invoice = self.validate_action(query)
+        # Audited and published once the transaction is over, so that neither
+        # the audit log nor the dashboard show a use or payment that was rolled
+        # back.
+        audits: List[Tuple[str, dict]] = []
+        events: List[Tuple[str, dict]] = []
+        try:
+            async with db.connect() as conn:
+                used = False
+                if self.initial_uses > 0:
+                    used = await self.use(conn)
+                    if not used:
+                        audits.append(("use", {"used": False}))
+                        raise LnurlValidationError(
+                            "Maximum number of uses already reached"
+                        )
+                tag = self.tag
+                if tag == "withdrawRequest":
+                    assert invoice
+                    event = {
+                        "atmbitbit": self.atmbitbit,
+                        "lnurl": self.id,
+                        "amount_msat": invoice.amount_msat,
+                    }
+                    # The withdrawal's records are written before paying, so they
+                    # commit with the use, and only if the payment succeeds.
+                    if record:
+                        await record(conn, invoice)
+                    failed = {"amount_msat": invoice.amount_msat}
+                    try:
+                        await pay_invoice(
+                            wallet_id=self.wallet, payment_request=query["pr"]
+                        )
+                    except (ValueError, PermissionError, PaymentFailure) as e:
+                        # Don't hold the funds of a withdrawal that wasn't paid.
+                        wallet_liquidity.release(self.wallet, self.hash)
+                        events.append(
+                            ("withdrawal.failed", {**event, "reason": str(e)})
+                        )
+                        audits.append(("payment_failed", {**failed, "reason": str(e)}))
+                        raise LnurlValidationError("Failed to pay invoice: " + str(e))
+                    except Exception as e:
+                        logger.error(str(e))
+                        wallet_liquidity.release(self.wallet, self.hash)
+                        events.append(
+                            (
+                                "withdrawal.failed",
+                                {**event, "reason": "Unexpected error"},
+                            )
+                        )
+                        audits.append(("payment_failed", {**failed, "reason": str(e)}))
+                        raise LnurlValidationError("Unexpected error")
+                    events.append(("withdrawal.succeeded", event))
+                    audits.append(
+                        (
+                            "payment_succeeded",
+                            {
+                                "amount_msat": invoice.amount_msat,
+                                "payment_hash": invoice.payment_hash,
+                            },
+                        )
                     )
-                except (ValueError, PermissionError, PaymentFailure) as e:
-                    raise LnurlValidationError("Failed to pay invoice: " + str(e))
-                except Exception as e:
-                    logger.error(str(e))
-                    raise LnurlValidationError("Unexpected error")
+                if used:
+                    audits.append(("use", {"used": True}))
+        except LnurlValidationError:
+            # Rolled back because of the failure that was recorded.
+            self.report(audits, events)
+            raise
+        self.report(audits, events)
+        return invoice
+
+    def report(
+        self, audits: List[Tuple[str, dict]], events: List[Tuple[str, dict]]
+    ) -> None:
+        for event, data in audits:
+            audit_log.log(event, self.atmbitbit, self.id, **data)
+        for event, data in events:
+            atmbitbit_events.publish(event, self.wallet, data)
+
+    def get_paid_fiat(self, amount_msat: int) -> Tuple[float, int]:
+        # fiatAmount and feeMsat were taken at maxWithdrawable. An invoice for
+        # less pays the same share of both. Returns (fiat amount, fee msats).
+        params = json.loads(self.params)
+        if "fiatAmount" not in params or not params["maxWithdrawable"]:
+            return 0, 0
+        share = amount_msat / params["maxWithdrawable"]
+        return (
+            round(params["fiatAmount"] * share, 8),
+            int(params.get("feeMsat", 0) * share),
+        )
 
     async def use(self, conn) -> bool:
         now = int(time.time())
+        if self.initial_uses > 1:
+            return await self.use_shard(conn, now)
         result = await conn.execute(
             """
             UPDATE atmbitbit.atmbitbit_lnurls
@@ -140,3 +251,80 @@ class AtmBitBitLnurl(BaseModel):
             (now, self.id),
         )
         return result.rowcount > 0
+
+    async def use_shard(self, conn, now: int) -> bool:
+        # Takes one use from a shard, trying the shards with uses left in random
+        # order so that concurrent redemptions mostly update different rows.
+        # Only existing shards are tried: LNURLs migrated by m008 have just one.
+        # A shard is only decremented while it has uses left, so uses can never
+        # be overspent. The shard also records the time, as the LNURL row isn't
+        # written.
+        rows = await conn.fetchall(
+            """
+            SELECT shard FROM atmbitbit.lnurl_uses
+            WHERE lnurl = ? AND remaining_uses > 0
+            """,
+            (self.id,),
+        )
+        shards = [row["shard"] for row in rows]
+        random.shuffle(shards)
+        for shard in shards:
+            result = await conn.execute(
+                """
+                UPDATE atmbitbit.lnurl_uses
+                SET remaining_uses = remaining_uses - 1, updated_time = ?
+                WHERE lnurl = ? AND shard = ?
+                    AND remaining_uses > 0
+                """,
+                (now, self.id, shard),
+            )
+            if result.rowcount > 0:
+                return True
+        return False
+
+
+def get_lnurl_use_shards(uses: int) -> int:
+    return min(uses, 8)
+
+
+class AtmBitBitWithdrawal(BaseModel):
+    id: str
+    atmbitbit: str
+    lnurl: str
+    payment_hash: Optional[str]
+    amount_msat: int
+    fiat_currency: Optional[str]
+    fiat_amount: Optional[float]
+    exchange_rate: Optional[float]
+    fee_msat: Optional[int]
+    created_time: int
+
+
+class AtmBitBitWithdrawalRollup(BaseModel):
+    atmbitbit: str
+    day: str
+    fiat_currency: str
+    count: int
+    total_msat: int
+    total_fiat: float
+    total_fee_msat: int
+
+
+class ExchangeRateSample(BaseModel):
+    provider: str
+    currency: str
+    rate: float
+    fetched_time: int
+
+
+class WebhookDelivery(BaseModel):
+    id: str
+    atmbitbit: str
+    url: str
+    payload: str
+    signature: Optional[str]
+    status: str
+    attempts: int
+    last_error: Optional[str]
+    next_attempt_time: int
+    created_time: int
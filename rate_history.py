@@ -0,0 +1,102 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+from .crud import (
+    create_exchange_rate_samples,
+    delete_exchange_rate_samples,
+    get_latest_exchange_rate_sample,
+)
+from .exchange_rates import fetch_fiat_exchange_rate
+from .models import ExchangeRateSample
+
+
+class ExchangeRateHistory:
+    """
+    Keeps every fetched exchange rate, downsampled to one sample per pair
+    (provider, currency) per interval, and writes them to the database in
+    batches with flush(). prune() deletes the samples older than retention
+    seconds, at most once per prune_interval.
+    """
+
+    def __init__(
+        self,
+        interval: int = 60,
+        retention: int = 30 * 24 * 3600,
+        prune_interval: float = 3600.0,
+    ):
+        self.interval = interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self._latest: Dict[Tuple[str, str], ExchangeRateSample] = {}
+        self._pending: Dict[Tuple[str, str, int], ExchangeRateSample] = {}
+        self._last_prune: Optional[float] = None
+
+    def record(self, sample: ExchangeRateSample) -> None:
+        pair = (sample.provider, sample.currency)
+        self._latest[pair] = sample
+        bucket = sample.fetched_time - sample.fetched_time % self.interval
+        self._pending.setdefault((*pair, bucket), sample)
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await create_exchange_rate_samples(list(pending.values()), self.interval)
+        except Exception as e:
+            logger.error(f"Failed to write {len(pending)} exchange rate samples: {e}")
+            # Kept for the next flush. They are the first of their intervals,
+            # so they win over samples recorded in the meantime.
+            self._pending = {**self._pending, **pending}
+
+    async def prune(self) -> None:
+        now = time.monotonic()
+        if (
+            self._last_prune is not None
+            and now - self._last_prune < self.prune_interval
+        ):
+            return
+        self._last_prune = now
+        await delete_exchange_rate_samples(int(time.time()) - self.retention)
+
+    async def get_latest(
+        self, provider: str, currency: str, max_age: int
+    ) -> Optional[ExchangeRateSample]:
+        since = int(time.time()) - max_age
+        sample = self._latest.get((provider, currency))
+        if sample and sample.fetched_time >= since:
+            return sample
+        # Another worker may have fetched it more recently.
+        return await get_latest_exchange_rate_sample(provider, currency, since)
+
+
+exchange_rate_history = ExchangeRateHistory()
+
+
+async def get_fiat_exchange_rate(
+    currency: str, provider: str, max_age: int = 0
+) -> ExchangeRateSample:
+    # Fetches the rate from the provider. If that fails and max_age is set, a
+    # rate fetched at most max_age seconds ago is returned instead.
+    try:
+        rate = await fetch_fiat_exchange_rate(currency=currency, provider=provider)
+    except Exception as e:
+        if max_age > 0:
+            sample = await exchange_rate_history.get_latest(provider, currency, max_age)
+            if sample:
+                logger.warning(
+                    f"Using exchange rate from {sample.fetched_time} for BTC/{currency}"
+                    f' because "{provider}" failed: {e}'
+                )
+                return sample
+        raise
+    sample = ExchangeRateSample(
+        provider=provider,
+        currency=currency,
+        rate=rate,
+        fetched_time=int(time.time()),
+    )
+    exchange_rate_history.record(sample)
+    return sample
@@ -0,0 +1,194 @@
+"""
+Replays a trace written by the /u traffic recorder (see traffic.py) against a
+running LNbits instance:
+
+    python -m lnbits.extensions.atmbitbit.replay trace.*.jsonl* \\
+        --url http://127.0.0.1:5000/atmbitbit/u \\
+        --atm <api_key_id>:<api_key_secret>[:<api_key_encoding>] [--atm ...] \\
+        [--speed 2] [--pr <bolt11 invoice>]
+
+The recorded API key IDs are mapped round-robin onto the given test ATMs and
+every signed request is signed again with their keys and a fresh nonce.
+Callbacks get the k1 of the LNURL their replayed request created. Pass the
+files of all recording processes (and their rotated backups); they are merged
+in time order.
+"""
+
+import argparse
+import asyncio
+import json
+import secrets
+import statistics
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from .helpers import (
+    generate_atmbitbit_lnurl_secret,
+    generate_atmbitbit_lnurl_signature,
+    query_to_signing_payload,
+    unshorten_lnurl_query,
+)
+
+TestAtm = Tuple[str, str, str]
+
+
+def parse_atm(value: str) -> TestAtm:
+    parts = value.split(":")
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError(
+            "Expected <api_key_id>:<api_key_secret>[:<api_key_encoding>]"
+        )
+    api_key_id, api_key_secret = parts[:2]
+    return api_key_id, api_key_secret, parts[2] if len(parts) == 3 else "hex"
+
+
+def load_trace(*paths: str) -> List[dict]:
+    # Merges the files of all processes and makes times relative to the first
+    # request.
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["t"])
+    start = records[0]["t"] if records else 0
+    for record in records:
+        record["t"] -= start
+    return records
+
+
+def get_percentiles(durations: List[float]) -> Dict[str, float]:
+    if len(durations) < 2:
+        value = durations[0] if durations else 0.0
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(durations, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+class TraceReplayer:
+    def __init__(self, atms: List[TestAtm], pr: Optional[str] = None):
+        self.atms = atms
+        self.pr = pr
+        self._atms_by_pseudonym: Dict[str, TestAtm] = {}
+        self._k1s: Dict[str, str] = {}
+
+    def get_atm(self, pseudonym: str) -> TestAtm:
+        if pseudonym not in self._atms_by_pseudonym:
+            index = len(self._atms_by_pseudonym) % len(self.atms)
+            self._atms_by_pseudonym[pseudonym] = self.atms[index]
+        return self._atms_by_pseudonym[pseudonym]
+
+    def prepare_query(self, record: dict) -> Dict[str, str]:
+        query = dict(record["q"])
+        signature_key = "s" if "s" in query else "signature"
+        if signature_key in query and "id" in query:
+            api_key_id, api_key_secret, api_key_encoding = self.get_atm(query["id"])
+            del query[signature_key]
+            query["id"] = api_key_id
+            query["n" if "n" in query else "nonce"] = secrets.token_hex(8)
+            payload = query_to_signing_payload(unshorten_lnurl_query(query))
+            signature = generate_atmbitbit_lnurl_signature(
+                payload, api_key_secret, api_key_encoding
+            )
+            query[signature_key] = signature
+            if "k1" in record:
+                self._k1s[record["k1"]] = generate_atmbitbit_lnurl_secret(
+                    api_key_id, signature
+                )
+        if "k1" in query:
+            # Callbacks of LNURLs created outside of the trace can't succeed.
+            query["k1"] = self._k1s.get(query["k1"]) or secrets.token_hex(32)
+        if "pr" in query:
+            query["pr"] = self.pr or query["pr"]
+        return query
+
+    async def replay(
+        self, records: List[dict], url: str, speed: float = 1.0
+    ) -> List[Tuple[dict, float, Optional[dict]]]:
+        results: List[Tuple[dict, float, Optional[dict]]] = []
+        loop = asyncio.get_event_loop()
+
+        async with httpx.AsyncClient(timeout=30.0) as client:
+
+            async def send(record: dict, query: Dict[str, str], start: float):
+                await asyncio.sleep(max(0.0, start + record["t"] / speed - loop.time()))
+                started = loop.time()
+                try:
+                    r = await client.get(url, params=query)
+                    response = r.json()
+                except Exception:
+                    response = None
+                results.append((record, (loop.time() - started) * 1000, response))
+
+            start = loop.time()
+            tasks = []
+            for record in records:
+                await asyncio.sleep(
+                    max(0.0, start + record["t"] / speed - loop.time() - 0.01)
+                )
+                # Queries are prepared in trace order, so creations map their
+                # k1 before the callbacks that follow them.
+                query = self.prepare_query(record)
+                tasks.append(asyncio.create_task(send(record, query, start)))
+            await asyncio.gather(*tasks)
+        return results
+
+
+def print_report(results: List[Tuple[dict, float, Optional[dict]]]) -> None:
+    recorded = [record["d"] for record, _, _ in results]
+    replayed = [duration for _, duration, _ in results]
+    failed = sum(1 for _, _, response in results if not response)
+    errors = sum(
+        1
+        for _, _, response in results
+        if response and response.get("status") == "ERROR"
+    )
+    mismatched = sum(
+        1
+        for record, _, response in results
+        if response and (response.get("status") or response.get("tag")) != record["r"]
+    )
+    print(f"requests: {len(results)}, failed: {failed}, errors: {errors}")
+    print(f"outcome differs from the recording: {mismatched}")
+    print("latency (ms)  recorded  replayed")
+    recorded_percentiles = get_percentiles(recorded)
+    replayed_percentiles = get_percentiles(replayed)
+    for name in ("p50", "p95", "p99"):
+        print(
+            f"{name:>12}  {recorded_percentiles[name]:8.1f}"
+            f"  {replayed_percentiles[name]:8.1f}"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded /u traffic.")
+    parser.add_argument(
+        "traces", nargs="+", help="trace files written by the traffic recorder"
+    )
+    parser.add_argument("--url", required=True, help="URL of the /u endpoint")
+    parser.add_argument(
+        "--atm",
+        action="append",
+        required=True,
+        type=parse_atm,
+        help="test ATM as <api_key_id>:<api_key_secret>[:<api_key_encoding>]",
+    )
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="2 replays twice as fast"
+    )
+    parser.add_argument("--pr", help="invoice sent with withdrawal callbacks")
+    args = parser.parse_args(argv)
+    if args.speed <= 0:
+        parser.error("--speed must be greater than 0")
+
+    records = load_trace(*args.traces)
+    started = time.monotonic()
+    replayer = TraceReplayer(args.atm, args.pr)
+    results = asyncio.run(replayer.replay(records, args.url, args.speed))
+    print(f"replayed {len(records)} requests in {time.monotonic() - started:.1f}s")
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
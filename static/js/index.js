@@ -1,4 +1,4 @@
-/* global Vue, VueQrcode, _, Quasar, LOCALE, windowMixin, LNbits */
+/* global Vue, VueQrcode, _, Quasar, LOCALE, windowMixin, LNbits, axios, EventSource */
 
 Vue.component(VueQrcode.name, VueQrcode)
 
@@ -11,7 +11,9 @@ var defaultValues = {
   name: 'My AtmBitBit',
   fiat_currency: 'EUR',
   exchange_rate_provider: 'coinbase',
-  fee: '0.00'
+  fee: '0.00',
+  max_rate_age: 0,
+  webhook_url: ''
 }
 
 new Vue({
@@ -20,6 +22,7 @@ new Vue({
   data: function () {
     return {
       checker: null,
+      eventSource: null,
       atmbitbits: [],
       atmbitbitsTable: {
         columns: [
@@ -60,10 +63,8 @@ new Vue({
       },
       formDialog: {
         show: false,
-        fiatCurrencies: _.keys(window.atmbitbit_vars.fiat_currencies),
-        exchangeRateProviders: _.keys(
-          window.atmbitbit_vars.exchange_rate_providers
-        ),
+        fiatCurrencies: [],
+        exchangeRateProviders: [],
         data: _.clone(defaultValues)
       }
     }
@@ -79,6 +80,21 @@ new Vue({
     }
   },
   methods: {
+    getBootstrap: function () {
+      var self = this
+      // Versioned URL, so browsers keep the response in their cache.
+      axios
+        .get(window.atmbitbit_vars.bootstrap_url)
+        .then(function (response) {
+          self.formDialog.fiatCurrencies = _.keys(response.data.fiat_currencies)
+          self.formDialog.exchangeRateProviders = _.keys(
+            response.data.exchange_rate_providers
+          )
+        })
+        .catch(function (error) {
+          LNbits.utils.notifyApiError(error)
+        })
+    },
     getAtmBitBits: function () {
       var self = this
       LNbits.api
@@ -94,9 +110,57 @@ new Vue({
         })
         .catch(function (error) {
           clearInterval(self.checker)
+          if (self.eventSource) {
+            self.eventSource.close()
+          }
           LNbits.utils.notifyApiError(error)
         })
     },
+    listenForChanges: function () {
+      var self = this
+      var eventSource = new EventSource(
+        '/atmbitbit/api/v1/events?all_wallets=true&api-key=' +
+          this.g.user.wallets[0].inkey
+      )
+      var upsertAtmBitBit = function (event) {
+        var atmbitbit = JSON.parse(event.data)
+        self.atmbitbits = _.reject(self.atmbitbits, function (obj) {
+          return obj.id === atmbitbit.id
+        })
+        self.atmbitbits.push(mapAtmBitBit(atmbitbit))
+      }
+      eventSource.addEventListener('atmbitbit.created', upsertAtmBitBit)
+      eventSource.addEventListener('atmbitbit.updated', upsertAtmBitBit)
+      eventSource.addEventListener('atmbitbit.deleted', function (event) {
+        var data = JSON.parse(event.data)
+        self.atmbitbits = _.reject(self.atmbitbits, function (obj) {
+          return obj.id === data.id
+        })
+      })
+      var notifyWithdrawal = function (event) {
+        var data = JSON.parse(event.data)
+        var atmbitbit = _.findWhere(self.atmbitbits, {id: data.atmbitbit})
+        var amount = Math.floor(data.amount_msat / 1000) + ' sats'
+        var name = atmbitbit ? atmbitbit.name : data.atmbitbit
+        var succeeded = event.type === 'withdrawal.succeeded'
+        var message = name + ': withdrawal of ' + amount
+        if (!succeeded) {
+          message += ' failed (' + data.reason + ')'
+        }
+        Quasar.plugins.Notify.create({
+          message: message,
+          color: succeeded ? 'positive' : 'negative',
+          icon: null
+        })
+      }
+      eventSource.addEventListener('withdrawal.succeeded', notifyWithdrawal)
+      eventSource.addEventListener('withdrawal.failed', notifyWithdrawal)
+      // Sent when events were missed while disconnected.
+      eventSource.addEventListener('resync', function () {
+        self.getAtmBitBits()
+      })
+      this.eventSource = eventSource
+    },
     closeFormDialog: function () {
       this.formDialog.data = _.clone(defaultValues)
     },
@@ -131,6 +195,31 @@ new Vue({
         })
       }
     },
+    exportAllConfigFiles: function () {
+      axios({
+        method: 'GET',
+        url: '/atmbitbit/api/v1/atmbitbits/config?all_wallets=true',
+        headers: {'X-Api-Key': this.g.user.wallets[0].adminkey},
+        responseType: 'blob'
+      })
+        .then(function (response) {
+          var status = Quasar.utils.exportFile(
+            'atmbitbit.zip',
+            response.data,
+            'application/zip'
+          )
+          if (status !== true) {
+            Quasar.plugins.Notify.create({
+              message: 'Browser denied file download...',
+              color: 'negative',
+              icon: null
+            })
+          }
+        })
+        .catch(function (error) {
+          LNbits.utils.notifyApiError(error)
+        })
+    },
     openUpdateDialog: function (atmbitbitId) {
       var atmbitbit = _.findWhere(this.atmbitbits, {id: atmbitbitId})
       this.formDialog.data = _.clone(atmbitbit._data)
@@ -154,7 +243,15 @@ new Vue({
           'PUT',
           '/atmbitbit/api/v1/atmbitbit/' + data.id,
           wallet.adminkey,
-          _.pick(data, 'name', 'fiat_currency', 'exchange_rate_provider', 'fee')
+          _.pick(
+            data,
+            'name',
+            'fiat_currency',
+            'exchange_rate_provider',
+            'fee',
+            'max_rate_age',
+            'webhook_url'
+          )
         )
         .then(function (response) {
           self.atmbitbits = _.reject(self.atmbitbits, function (obj) {
@@ -205,12 +302,24 @@ new Vue({
     }
   },
   created: function () {
+    this.getBootstrap()
     if (this.g.user.wallets.length) {
       var getAtmBitBits = this.getAtmBitBits
-      getAtmBitBits()
-      this.checker = setInterval(function () {
+      if (window.EventSource) {
+        this.listenForChanges()
+        getAtmBitBits()
+      } else {
         getAtmBitBits()
-      }, 20000)
+        this.checker = setInterval(function () {
+          getAtmBitBits()
+        }, 20000)
+      }
+    }
+  },
+  beforeDestroy: function () {
+    clearInterval(this.checker)
+    if (this.eventSource) {
+      this.eventSource.close()
     }
   }
 })
@@ -0,0 +1,17 @@
+import asyncio
+
+from .liquidity import wallet_liquidity
+from .rate_history import exchange_rate_history
+
+
+async def flush_exchange_rate_history():
+    while True:
+        await asyncio.sleep(exchange_rate_history.interval)
+        await exchange_rate_history.flush()
+        await exchange_rate_history.prune()
+
+
+async def refresh_wallet_liquidity():
+    while True:
+        await asyncio.sleep(wallet_liquidity.refresh_interval)
+        await wallet_liquidity.refresh()
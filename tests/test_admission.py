@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from lnbits.extensions.atmbitbit.admission import (
+    PRIORITY_CALLBACK,
+    PRIORITY_CREATE,
+    AdmissionController,
+    AdmissionShed,
+)
+
+
+@pytest.mark.asyncio
+async def test_admission_callbacks_first_and_creates_shed():
+    controller = AdmissionController(
+        max_concurrent=1,
+        latency_targets={PRIORITY_CALLBACK: 2.0, PRIORITY_CREATE: 0.5},
+    )
+    admitted = []
+
+    async def request(priority, name, duration):
+        try:
+            async with controller.admit(priority):
+                admitted.append(name)
+                await asyncio.sleep(duration)
+        except AdmissionShed:
+            admitted.append(f"shed {name}")
+
+    await asyncio.gather(
+        request(PRIORITY_CREATE, "create 1", 0.2),
+        request(PRIORITY_CREATE, "create 2", 0.3),
+        request(PRIORITY_CALLBACK, "callback", 0.2),
+        request(PRIORITY_CREATE, "create 3", 0.1),
+    )
+    # The callback overtakes the waiting creates. "create 3" waits longer
+    # than its 0.5s latency target and is shed.
+    assert admitted == ["create 1", "callback", "create 2", "shed create 3"]
+    stats = controller.stats()
+    assert stats["active"] == 0
+    assert stats["waiting"] == 0
+    assert stats["admitted"] == {"callback": 1, "create": 2}
+    assert stats["shed"] == {"callback": 0, "create": 1}
+
+
+@pytest.mark.asyncio
+async def test_admission_sheds_on_arrival_when_wait_is_too_long():
+    controller = AdmissionController(
+        max_concurrent=1,
+        latency_targets={PRIORITY_CALLBACK: 2.0, PRIORITY_CREATE: 0.5},
+    )
+    # Requests hold the slot for about 0.3s.
+    async with controller.admit(PRIORITY_CREATE):
+        await asyncio.sleep(0.3)
+
+    async def request():
+        async with controller.admit(PRIORITY_CREATE):
+            await asyncio.sleep(0.3)
+
+    running = asyncio.create_task(request())
+    await asyncio.sleep(0)
+    # Expected to wait about 0.3s: queued.
+    waiting = asyncio.create_task(request())
+    await asyncio.sleep(0)
+    # Expected to wait about 0.6s: shed right away instead of after 0.5s.
+    loop = asyncio.get_event_loop()
+    started = loop.time()
+    with pytest.raises(AdmissionShed):
+        async with controller.admit(PRIORITY_CREATE):
+            pass
+    assert loop.time() - started < 0.1
+    await asyncio.gather(running, waiting)
+    assert controller.stats()["admitted"]["create"] == 3
+    assert controller.stats()["shed"]["create"] == 1
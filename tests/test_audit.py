@@ -0,0 +1,72 @@
+import asyncio
+import secrets
+
+import pytest
+
+from lnbits.extensions.atmbitbit import audit, db
+from lnbits.extensions.atmbitbit.audit import AuditLog
+
+
+@pytest.mark.asyncio
+async def test_audit_log_flush():
+    audit_log = AuditLog()
+    atmbitbit_id = secrets.token_hex(8)
+    for i in range(3):
+        audit_log.log("use", atmbitbit_id, f"lnurl-{i}", used=True)
+    await audit_log.flush()
+    rows = await db.fetchall(
+        "SELECT * FROM atmbitbit.audit_log WHERE atmbitbit = ? ORDER BY id",
+        (atmbitbit_id,),
+    )
+    assert [row["lnurl"] for row in rows] == ["lnurl-0", "lnurl-1", "lnurl-2"]
+    assert rows[0]["event"] == "use"
+    assert rows[0]["data"] == '{"used": true}'
+
+
+@pytest.mark.asyncio
+async def test_audit_log_drops_events_when_queue_is_full():
+    audit_log = AuditLog(max_queue_size=2)
+    atmbitbit_id = secrets.token_hex(8)
+    for i in range(3):
+        audit_log.log("callback", atmbitbit_id, f"lnurl-{i}")
+    assert audit_log.dropped == 1
+    await audit_log.flush()
+    rows = await db.fetchall(
+        "SELECT * FROM atmbitbit.audit_log WHERE atmbitbit = ?", (atmbitbit_id,)
+    )
+    assert len(rows) == 2
+
+
+@pytest.mark.asyncio
+async def test_audit_log_keeps_batch_when_write_fails(monkeypatch):
+    class UnavailableDatabase:
+        def connect(self):
+            raise ConnectionError("database unavailable")
+
+    audit_log = AuditLog()
+    atmbitbit_id = secrets.token_hex(8)
+    for i in range(2):
+        audit_log.log("callback", atmbitbit_id, f"lnurl-{i}")
+    monkeypatch.setattr(audit, "db", UnavailableDatabase())
+    await audit_log.flush()
+    monkeypatch.undo()
+    # flush() can't retry later, so it counts the events as dropped.
+    assert audit_log.dropped == 2
+
+    audit_log = AuditLog(flush_interval=0.01, retry_delay=0.01, max_retry_delay=0.01)
+    audit_log.log("callback", atmbitbit_id, "lnurl-2")
+    audit_log.log("callback", atmbitbit_id, "lnurl-3")
+    monkeypatch.setattr(audit, "db", UnavailableDatabase())
+    task = asyncio.create_task(audit_log.run())
+    # A few failed attempts, then the database is back.
+    await asyncio.sleep(0.1)
+    monkeypatch.undo()
+    await asyncio.sleep(0.1)
+    task.cancel()
+    await audit_log.flush()
+    assert audit_log.dropped == 0
+    rows = await db.fetchall(
+        "SELECT * FROM atmbitbit.audit_log WHERE atmbitbit = ? ORDER BY id",
+        (atmbitbit_id,),
+    )
+    assert [row["lnurl"] for row in rows] == ["lnurl-2", "lnurl-3"]
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from lnbits.extensions.atmbitbit import db
+from lnbits.extensions.atmbitbit.crud import (
+    atmbitbit_cache,
+    get_atmbitbit_by_api_key_id,
+    get_atmbitbit_withdrawal_rollups,
+    record_atmbitbit_withdrawal,
+)
+from lnbits.extensions.atmbitbit.cache import GenerationCache
+from lnbits.extensions.atmbitbit.models import AtmBitBitLnurl
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_cache_drops_rows_deleted_by_other_workers(atmbitbit):
+    cached = await get_atmbitbit_by_api_key_id(atmbitbit.api_key_id)
+    assert cached
+    assert atmbitbit_cache.get(atmbitbit.api_key_id) is cached
+    # Delete the way another worker would: this worker's cache isn't told.
+    await db.execute("DELETE FROM atmbitbit.atmbitbits WHERE id = ?", (atmbitbit.id,))
+    await db.execute(
+        "UPDATE atmbitbit.generations SET generation = generation + 1 WHERE wallet = ?",
+        (atmbitbit.wallet,),
+    )
+    check_interval = atmbitbit_cache.check_interval
+    try:
+        atmbitbit_cache.check_interval = 0
+        assert await get_atmbitbit_by_api_key_id(atmbitbit.api_key_id) is None
+    finally:
+        atmbitbit_cache.check_interval = check_interval
+
+
+def test_atmbitbit_lnurl_paid_fiat_follows_invoice_amount():
+    lnurl = AtmBitBitLnurl(
+        id="lnurl",
+        atmbitbit="atmbitbit",
+        wallet="wallet",
+        hash="hash",
+        tag="withdrawRequest",
+        params=json.dumps(
+            {
+                "minWithdrawable": 99000,
+                "maxWithdrawable": 990000,
+                "fiatAmount": 10,
+                "feeMsat": 10000,
+            }
+        ),
+        api_key_id="api_key_id",
+        initial_uses=1,
+        remaining_uses=1,
+        created_time=0,
+        updated_time=0,
+    )
+    assert lnurl.get_paid_fiat(990000) == (10, 10000)
+    assert lnurl.get_paid_fiat(495000) == (5, 5000)
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_withdrawal_rollup_adds_up(lnurl):
+    atmbitbit = lnurl["atmbitbit"]
+    await record_atmbitbit_withdrawal(lnurl["lnurl"], 50000)
+    await record_atmbitbit_withdrawal(lnurl["lnurl"], 20000)
+    rollups = await get_atmbitbit_withdrawal_rollups(atmbitbit.id)
+    assert len(rollups) == 1
+    assert rollups[0].count == 2
+    assert rollups[0].total_msat == 70000
+
+
+@pytest.mark.asyncio
+async def test_generation_cache_revalidates_in_batches():
+    batches = []
+
+    async def fetch_generations(wallets):
+        batches.append(len(wallets))
+        return {wallet: 1 for wallet in wallets}
+
+    cache = GenerationCache(fetch_generations, check_interval=0, batch_size=500)
+    for i in range(1200):
+        cache.put(f"key-{i}", i, f"wallet-{i}", 1 if i % 2 else 0)
+    await cache.revalidate()
+    assert batches == [500, 500, 200]
+    # Entries loaded at an older generation than the current one are dropped.
+    assert cache.get("key-1") == 1
+    assert cache.get("key-2") is None
@@ -0,0 +1,39 @@
+import pytest
+
+from lnbits.extensions.atmbitbit.events import AtmBitBitEventBroadcaster
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_events_filtered_by_wallet():
+    broadcaster = AtmBitBitEventBroadcaster()
+    with broadcaster.subscribe(["wallet-a"]) as subscription:
+        broadcaster.publish("atmbitbit.updated", "wallet-b", {"id": "x"})
+        broadcaster.publish("atmbitbit.updated", "wallet-a", {"id": "y"})
+        event = await subscription.queue.get()
+        assert event.type == "atmbitbit.updated"
+        assert event.data == {"id": "y"}
+        assert subscription.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_events_replay_from_last_event_id():
+    broadcaster = AtmBitBitEventBroadcaster(history_size=3)
+    for i in range(3):
+        broadcaster.publish("atmbitbit.updated", "wallet-a", {"id": str(i)})
+    first_id = broadcaster.replay(f"{broadcaster.boot}:0", ["wallet-a"])[0].id
+    missed = broadcaster.replay(first_id, ["wallet-a"])
+    assert [event.data["id"] for event in missed] == ["1", "2"]
+    broadcaster.publish("atmbitbit.updated", "wallet-a", {"id": "3"})
+    # The first event has been evicted from the history.
+    assert broadcaster.replay(f"{broadcaster.boot}:0", ["wallet-a"]) is None
+    assert broadcaster.replay("other-boot:1", ["wallet-a"]) is None
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_events_slow_subscriber_overflows():
+    broadcaster = AtmBitBitEventBroadcaster(queue_size=2)
+    with broadcaster.subscribe(["wallet-a"]) as subscription:
+        for i in range(3):
+            broadcaster.publish("atmbitbit.updated", "wallet-a", {"id": str(i)})
+        assert subscription.overflowed
+        assert subscription.queue.qsize() == 2
@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from lnbits.extensions.atmbitbit.exchange_rates import (
+    exchange_rate_providers,
+    exchange_rate_streams,
+    fetch_fiat_exchange_rate,
+)
+
+
+async def wait_for_rate(rate: float, timeout: float = 5.0):
+    for _ in range(int(timeout / 0.05)):
+        if await fetch_fiat_exchange_rate(currency="EUR", provider="stream") == rate:
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Rate {rate} was never returned")
+
+
+@pytest.mark.asyncio
+async def test_exchange_rate_stream():
+    prices = ["25000", "26000"]
+    subscriptions = []
+
+    # Local stand-in for a websocket ticker: sends one price per connection and
+    # then hangs up, so the second price is only seen after a reconnect.
+    async def ticker(ws, path=None):
+        subscriptions.append(json.loads(await ws.recv()))
+        if prices:
+            await ws.send(json.dumps({"price": prices.pop(0)}))
+
+    server = await websockets.serve(ticker, "localhost", 0)
+    port = server.sockets[0].getsockname()[1]
+    exchange_rate_providers["stream"] = {
+        "name": "stream",
+        "domain": None,
+        "api_url": None,
+        "getter": lambda data, replacements: "20000",
+        "stream": {
+            "url": f"ws://localhost:{port}",
+            "subscribe": lambda replacements: {"pair": replacements["TO"]},
+            "getter": lambda data, replacements: data.get("price"),
+        },
+    }
+    try:
+        # Nothing received yet: the REST getter answers.
+        rate = await fetch_fiat_exchange_rate(currency="EUR", provider="stream")
+        assert rate == 20000
+        stream = exchange_rate_streams[("stream", "EUR")]
+        stream.reconnect_delay = 0.05
+        await wait_for_rate(26000)
+        assert {"pair": "EUR"} in subscriptions
+        # The stand-in has no more prices, so the stream goes silent.
+        stream.max_silence = 0.1
+        await asyncio.sleep(0.2)
+        rate = await fetch_fiat_exchange_rate(currency="EUR", provider="stream")
+        assert rate == 20000
+    finally:
+        exchange_rate_streams.pop(("stream", "EUR")).stop()
+        del exchange_rate_providers["stream"]
+        server.close()
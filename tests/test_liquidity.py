@@ -0,0 +1,18 @@
+import pytest
+
+from lnbits.extensions.atmbitbit.liquidity import WalletLiquidity
+from tests.helpers import credit_wallet
+
+
+@pytest.mark.asyncio
+async def test_wallet_liquidity_evicts_idle_wallets(atmbitbit):
+    await credit_wallet(wallet_id=atmbitbit.wallet, amount=1000)
+    liquidity = WalletLiquidity(idle_ttl=0)
+    assert await liquidity.get_available(atmbitbit.wallet) == 1000
+    assert await liquidity.try_reserve(atmbitbit.wallet, "lnurl-hash", 400)
+    # Still refreshed while a withdrawal is reserved.
+    await liquidity.refresh()
+    assert await liquidity.get_available(atmbitbit.wallet) == 600
+    liquidity.release(atmbitbit.wallet, "lnurl-hash")
+    # Not looked up or reserved any more: no longer refreshed.
+    assert liquidity.evict_idle() == []
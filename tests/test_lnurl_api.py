@@ -1,9 +1,21 @@
+import asyncio
+import json
 import secrets
 
 import pytest
 
-from lnbits.core.crud import get_wallet
-from lnbits.extensions.atmbitbit.crud import get_atmbitbit_lnurl
+from lnbits.core.crud import create_account, create_wallet, get_wallet
+from lnbits.core.services import create_invoice
+from lnbits.extensions.atmbitbit import db, lnurl_api
+from lnbits.extensions.atmbitbit.audit import audit_log
+from lnbits.extensions.atmbitbit.crud import (
+    create_atmbitbit_lnurl,
+    get_atmbitbit_lnurl,
+    get_atmbitbit_withdrawal_rollups,
+    get_atmbitbit_withdrawals,
+    update_atmbitbit,
+)
+from lnbits.extensions.atmbitbit.exchange_rates import exchange_rate_providers
 from lnbits.extensions.atmbitbit.helpers import (
     generate_atmbitbit_lnurl_signature,
     query_to_signing_payload,
@@ -66,6 +78,7 @@ async def test_atmbitbit_lnurl_api_invalid_signature(client, atmbitbit):
 
 @pytest.mark.asyncio
 async def test_atmbitbit_lnurl_api_valid_signature(client, atmbitbit):
+    await credit_wallet(wallet_id=atmbitbit.wallet, amount=1000)
     query = {
         "id": atmbitbit.api_key_id,
         "nonce": secrets.token_hex(10),
@@ -94,6 +107,39 @@ async def test_atmbitbit_lnurl_api_valid_signature(client, atmbitbit):
     assert lnurl
 
 
+@pytest.mark.asyncio
+async def test_atmbitbit_lnurl_api_insufficient_liquidity(client, atmbitbit):
+    await credit_wallet(wallet_id=atmbitbit.wallet, amount=1500)
+
+    async def request_withdrawal():
+        query = {
+            "id": atmbitbit.api_key_id,
+            "nonce": secrets.token_hex(10),
+            "tag": "withdrawRequest",
+            "minWithdrawable": "1",
+            "maxWithdrawable": "1",
+            "defaultDescription": "test liquidity",
+            "f": "EUR",  # tests use the dummy exchange rate provider
+        }
+        payload = query_to_signing_payload(query)
+        signature = generate_atmbitbit_lnurl_signature(
+            payload=payload,
+            api_key_secret=atmbitbit.api_key_secret,
+            api_key_encoding=atmbitbit.api_key_encoding,
+        )
+        response = await client.get(f"/atmbitbit/u?{payload}&signature={signature}")
+        return response.json()
+
+    # Sent at once: only one of them may reserve the funds.
+    responses = await asyncio.gather(*[request_withdrawal() for _ in range(3)])
+    created = [response for response in responses if "tag" in response]
+    assert len(created) == 1
+    # The first withdrawal (1000 msats) is reserved, only 500 msats are left.
+    for response in responses:
+        if response not in created:
+            assert response == {"status": "ERROR", "reason": "Insufficient liquidity"}
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(is_regtest, reason="this test is only passes in fakewallet")
 async def test_atmbitbit_lnurl_api_action_insufficient_balance(client, lnurl):
@@ -114,6 +160,13 @@ async def test_atmbitbit_lnurl_api_action_insufficient_balance(client, lnurl):
     assert atmbitbit_lnurl, not None
     assert atmbitbit_lnurl.has_uses_remaining() is True
     WALLET.pay_invoice.assert_not_called()
+    # The use was rolled back, so only the failed payment is audited.
+    await audit_log.flush()
+    rows = await db.fetchall(
+        "SELECT event FROM atmbitbit.audit_log WHERE lnurl = ? ORDER BY id",
+        (atmbitbit_lnurl.id,),
+    )
+    assert [row["event"] for row in rows] == ["callback", "payment_failed"]
 
 
 @pytest.mark.asyncio
@@ -139,3 +192,184 @@ async def test_atmbitbit_lnurl_api_action_success(client, lnurl):
     assert atmbitbit_lnurl, not None
     assert atmbitbit_lnurl.has_uses_remaining() is False
     WALLET.pay_invoice.assert_called_once_with(pr, 2000)
+    rollups = await get_atmbitbit_withdrawal_rollups(atmbitbit.id)
+    assert len(rollups) == 1
+    assert rollups[0].count == 1
+    assert rollups[0].total_msat == 50000
+    assert rollups[0].fiat_currency == ""
+    withdrawals = await get_atmbitbit_withdrawals(atmbitbit.id)
+    assert len(withdrawals) == 1
+    assert withdrawals[0].lnurl == atmbitbit_lnurl.id
+    assert withdrawals[0].amount_msat == 50000
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(is_regtest, reason="this test is only passes in fakewallet")
+async def test_atmbitbit_lnurl_api_action_not_paid_when_not_recorded(
+    client, lnurl, monkeypatch
+):
+    atmbitbit = lnurl["atmbitbit"]
+    secret = lnurl["secret"]
+    pr = "lntb500n1pseq44upp5xqd38rgad72lnlh4gl339njlrsl3ykep82j6gj4g02dkule7k54qdqqcqzpgxqyz5vqsp5h0zgewuxdxcl2rnlumh6g520t4fr05rgudakpxm789xgjekha75s9qyyssq5vhwsy9knhfeqg0wn6hcnppwmum8fs3g3jxkgw45havgfl6evchjsz3s8e8kr6eyacz02szdhs7v5lg0m7wehd5rpf6yg8480cddjlqpae52xu"
+    await credit_wallet(wallet_id=atmbitbit.wallet, amount=100000)
+
+    async def failing_rollup(*args, **kwargs):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(lnurl_api, "record_atmbitbit_withdrawal", failing_rollup)
+    WALLET.pay_invoice.reset_mock()
+    response = await client.get(f"/atmbitbit/u?k1={secret}&pr={pr}")
+    assert response.json() == {"status": "ERROR", "reason": "Unexpected error"}
+    # The use and the withdrawal row were rolled back, and nothing was paid.
+    WALLET.pay_invoice.assert_not_called()
+    wallet = await get_wallet(atmbitbit.wallet)
+    assert wallet
+    assert wallet.balance_msat == 100000
+    atmbitbit_lnurl = await get_atmbitbit_lnurl(secret)
+    assert atmbitbit_lnurl
+    assert atmbitbit_lnurl.has_uses_remaining() is True
+    assert await get_atmbitbit_withdrawals(atmbitbit.id) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(is_regtest, reason="this test is only passes in fakewallet")
+async def test_atmbitbit_lnurl_api_uses_are_never_overspent(client, atmbitbit):
+    secret = secrets.token_hex(32)
+    lnurl = await create_atmbitbit_lnurl(
+        atmbitbit=atmbitbit,
+        secret=secret,
+        tag="withdrawRequest",
+        params=json.dumps(
+            {
+                "minWithdrawable": 50000,
+                "maxWithdrawable": 50000,
+                "defaultDescription": "test multi-use",
+            }
+        ),
+        uses=10,
+    )
+    assert lnurl.remaining_uses == 10
+    # Backdate the LNURL to see its uses move updated_time.
+    await db.execute(
+        "UPDATE atmbitbit.atmbitbit_lnurls SET updated_time = 0 WHERE id = ?",
+        (lnurl.id,),
+    )
+    # Enough funds for every callback, so only the uses can stop them.
+    await credit_wallet(wallet_id=atmbitbit.wallet, amount=50000 * 25)
+    user = await create_account()
+    customer = await create_wallet(user_id=user.id, wallet_name="atmbitbit_customer")
+    invoices = [
+        await create_invoice(wallet_id=customer.id, amount=50, memo=f"use {i}")
+        for i in range(25)
+    ]
+    # 25 callbacks in parallel for 10 uses, each with its own invoice.
+    responses = await asyncio.gather(
+        *[client.get(f"/atmbitbit/u?k1={secret}&pr={pr}") for _, pr in invoices]
+    )
+    results = [response.json() for response in responses]
+    assert results.count({"status": "OK"}) == 10
+    assert (
+        results.count(
+            {"status": "ERROR", "reason": "Maximum number of uses already reached"}
+        )
+        == 15
+    )
+    lnurl = await get_atmbitbit_lnurl(secret)
+    assert lnurl
+    assert lnurl.remaining_uses == 0
+    assert lnurl.updated_time > 0
+    withdrawals = await get_atmbitbit_withdrawals(atmbitbit.id)
+    assert len(withdrawals) == 10
+    wallet = await get_wallet(atmbitbit.wallet)
+    assert wallet
+    assert wallet.balance_msat == 50000 * 15
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_quote_api(client, atmbitbit):
+    query = {
+        "id": atmbitbit.api_key_id,
+        "nonce": secrets.token_hex(10),
+        "f": "EUR",  # tests use the dummy exchange rate provider
+        "amounts": "1,2.5,10",
+    }
+    payload = query_to_signing_payload(query)
+    response = await client.get(f"/atmbitbit/api/v1/quote?{payload}&signature=invalid")
+    assert response.json() == {"status": "ERROR", "reason": "Invalid API key signature"}
+    signature = generate_atmbitbit_lnurl_signature(
+        payload=payload,
+        api_key_secret=atmbitbit.api_key_secret,
+        api_key_encoding=atmbitbit.api_key_encoding,
+    )
+    response = await client.get(
+        f"/atmbitbit/api/v1/quote?{payload}&signature={signature}"
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status"] == "OK"
+    assert data["fiatCurrency"] == "EUR"
+    # Same amounts as the withdraw path: 1 EUR is 1 sat with the dummy rate.
+    assert [quote["msats"] for quote in data["quotes"]] == [1000, 2000, 10000]
+    assert [quote["feeMsat"] for quote in data["quotes"]] == [0, 0, 0]
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_quote_api_short_form_and_invalid_amounts(client, atmbitbit):
+    for amounts, status in [("5", "OK"), ("-5", "ERROR"), ("inf", "ERROR")]:
+        nonce = secrets.token_hex(10)
+        query = {
+            "id": atmbitbit.api_key_id,
+            "nonce": nonce,
+            "f": "EUR",  # tests use the dummy exchange rate provider
+            "amounts": amounts,
+        }
+        signature = generate_atmbitbit_lnurl_signature(
+            payload=query_to_signing_payload(query),
+            api_key_secret=atmbitbit.api_key_secret,
+            api_key_encoding=atmbitbit.api_key_encoding,
+        )
+        # Shortened like the ATM's signed URLs: "n" and "s".
+        del query["nonce"]
+        response = await client.get(
+            "/atmbitbit/api/v1/quote", params={**query, "n": nonce, "s": signature}
+        )
+        data = response.json()
+        assert data["status"] == status
+        if status == "ERROR":
+            assert data["reason"] == 'Invalid parameter ("amounts")'
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_quote_api_reuses_recent_rate(client, atmbitbit):
+    calls = []
+
+    def getter(data, replacements):
+        calls.append(replacements["TO"])
+        return str(1e8)
+
+    exchange_rate_providers["counting"] = {
+        "name": "counting",
+        "domain": None,
+        "api_url": None,
+        "getter": getter,
+    }
+    atmbitbit = await update_atmbitbit(atmbitbit.id, exchange_rate_provider="counting")
+    for _ in range(3):
+        query = {
+            "id": atmbitbit.api_key_id,
+            "nonce": secrets.token_hex(10),
+            "f": "EUR",
+            "amounts": "1,2.5,10",
+        }
+        payload = query_to_signing_payload(query)
+        signature = generate_atmbitbit_lnurl_signature(
+            payload=payload,
+            api_key_secret=atmbitbit.api_key_secret,
+            api_key_encoding=atmbitbit.api_key_encoding,
+        )
+        response = await client.get(
+            f"/atmbitbit/api/v1/quote?{payload}&signature={signature}"
+        )
+        assert response.json()["status"] == "OK"
+    # The first quote fetched the rate, the others reused it.
+    assert calls == ["EUR"]
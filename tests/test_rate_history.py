@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from lnbits.extensions.atmbitbit import db, rate_history
+from lnbits.extensions.atmbitbit.crud import get_latest_exchange_rate_sample
+from lnbits.extensions.atmbitbit.exchange_rates import exchange_rate_providers
+from lnbits.extensions.atmbitbit.models import ExchangeRateSample
+from lnbits.extensions.atmbitbit.rate_history import (
+    ExchangeRateHistory,
+    exchange_rate_history,
+    get_fiat_exchange_rate,
+)
+
+
+def unreachable(data, replacements):
+    raise ConnectionError("unreachable")
+
+
+exchange_rate_providers["unreachable"] = {
+    "name": "unreachable",
+    "domain": None,
+    "api_url": None,
+    "getter": unreachable,
+}
+
+
+@pytest.mark.asyncio
+async def test_exchange_rate_history_is_written_in_batches():
+    sample = await get_fiat_exchange_rate(currency="EUR", provider="dummy")
+    assert sample.rate == 1e8
+    # Earlier samples of the same interval may have been kept instead.
+    since = sample.fetched_time - exchange_rate_history.interval
+    await exchange_rate_history.flush()
+    stored = await get_latest_exchange_rate_sample("dummy", "EUR", since)
+    assert stored
+    assert stored.rate == 1e8
+
+
+@pytest.mark.asyncio
+async def test_exchange_rate_stale_fallback():
+    exchange_rate_history.record(
+        ExchangeRateSample(
+            provider="unreachable",
+            currency="EUR",
+            rate=20000.0,
+            fetched_time=int(time.time()) - 30,
+        )
+    )
+    with pytest.raises(ConnectionError):
+        await get_fiat_exchange_rate(currency="EUR", provider="unreachable")
+    with pytest.raises(ConnectionError):
+        await get_fiat_exchange_rate(currency="EUR", provider="unreachable", max_age=10)
+    sample = await get_fiat_exchange_rate(
+        currency="EUR", provider="unreachable", max_age=60
+    )
+    assert sample.rate == 20000.0
+
+
+@pytest.mark.asyncio
+async def test_exchange_rate_history_keeps_samples_when_write_fails(monkeypatch):
+    async def failing_write(samples, interval):
+        raise ConnectionError("database unavailable")
+
+    history = ExchangeRateHistory()
+    now = int(time.time())
+    history.record(
+        ExchangeRateSample(
+            provider="unwritten", currency="EUR", rate=20000.0, fetched_time=now
+        )
+    )
+    monkeypatch.setattr(rate_history, "create_exchange_rate_samples", failing_write)
+    await history.flush()
+    monkeypatch.undo()
+    await history.flush()
+    stored = await get_latest_exchange_rate_sample("unwritten", "EUR", now)
+    assert stored
+    assert stored.rate == 20000.0
+
+
+@pytest.mark.asyncio
+async def test_exchange_rate_history_prunes_old_samples():
+    history = ExchangeRateHistory(retention=3600)
+    now = int(time.time())
+    for age in [7200, 0]:
+        history.record(
+            ExchangeRateSample(
+                provider="pruned",
+                currency="EUR",
+                rate=20000.0 + age,
+                fetched_time=now - age,
+            )
+        )
+    await history.flush()
+    await history.prune()
+    rows = await db.fetchall(
+        "SELECT fetched_time FROM atmbitbit.exchange_rates WHERE provider = ?",
+        ("pruned",),
+    )
+    assert [row["fetched_time"] for row in rows] == [now]
@@ -0,0 +1,84 @@
+import json
+import os
+
+from lnbits.extensions.atmbitbit.helpers import (
+    generate_atmbitbit_lnurl_secret,
+    generate_atmbitbit_lnurl_signature,
+    query_to_signing_payload,
+    unshorten_lnurl_query,
+)
+from lnbits.extensions.atmbitbit.replay import TraceReplayer, load_trace
+from lnbits.extensions.atmbitbit.traffic import TrafficRecorder, get_trace_salt
+
+
+def sign_query(query: dict, api_key_secret: str) -> dict:
+    payload = query_to_signing_payload(unshorten_lnurl_query(query))
+    return {**query, "s": generate_atmbitbit_lnurl_signature(payload, api_key_secret)}
+
+
+def test_traffic_recorder_sanitizes_queries(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    recorder = TrafficRecorder(path)
+    query = sign_query(
+        {"id": "atm-id", "n": "nonce", "t": "w", "f": "EUR", "pn": "1", "px": "1"},
+        "00" * 32,
+    )
+    recorder.record(query, 0, 0.0125, {"tag": "withdrawRequest"})
+    recorder.stop()
+    with open(path) as f:
+        record = json.loads(f.readline())
+    assert record["d"] == 12.5
+    assert record["r"] == "withdrawRequest"
+    assert record["q"]["id"] == recorder.pseudonym("atm-id")
+    assert record["q"]["s"] != query["s"]
+    assert {key: record["q"][key] for key in ("t", "f", "pn", "px")} == {
+        "t": "w",
+        "f": "EUR",
+        "pn": "1",
+        "px": "1",
+    }
+    secret = generate_atmbitbit_lnurl_secret("atm-id", query["s"])
+    assert record["k1"] == recorder.pseudonym(secret)
+
+
+def test_replay_remaps_secrets_to_test_atms(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    recorder = TrafficRecorder(path)
+    query = sign_query({"id": "atm-id", "n": "nonce", "t": "w"}, "00" * 32)
+    secret = generate_atmbitbit_lnurl_secret("atm-id", query["s"])
+    recorder.record(query, 0, 0.01, {"tag": "withdrawRequest"})
+    recorder.record({"k1": secret, "pr": "lnbc1"}, 0, 0.01, {"status": "OK"})
+    recorder.stop()
+
+    test_secret = "11" * 32
+    replayer = TraceReplayer([("test-atm-id", test_secret, "hex")], pr="lnbc2")
+    create, callback = [replayer.prepare_query(r) for r in load_trace(path)]
+    assert create["id"] == "test-atm-id"
+    assert create["n"] != "nonce"
+    assert (
+        sign_query({k: v for k, v in create.items() if k != "s"}, test_secret)["s"]
+        == create["s"]
+    )
+    assert callback["k1"] == generate_atmbitbit_lnurl_secret("test-atm-id", create["s"])
+    assert callback["pr"] == "lnbc2"
+
+
+def test_traffic_recorders_of_one_trace_share_pseudonyms(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    # Each worker process reads the salt of the trace on its own.
+    worker_a = TrafficRecorder(str(tmp_path / "a.jsonl"), salt=get_trace_salt(path))
+    worker_b = TrafficRecorder(str(tmp_path / "b.jsonl"), salt=get_trace_salt(path))
+    worker_a.stop()
+    worker_b.stop()
+    assert worker_a.pseudonym("k1") == worker_b.pseudonym("k1")
+
+
+def test_trace_salt_without_hard_links(tmp_path, monkeypatch):
+    def link(src, dst):
+        raise PermissionError("hard links not supported")
+
+    monkeypatch.setattr(os, "link", link)
+    path = str(tmp_path / "trace.jsonl")
+    # Falls back to a salt of this process instead of failing the import.
+    assert len(get_trace_salt(path)) == 16
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,111 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from lnbits.core.crud import get_wallet
+from lnbits.extensions.atmbitbit.crud import create_atmbitbit_withdrawal
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_config_files_zip(client, atmbitbit):
+    wallet = await get_wallet(atmbitbit.wallet)
+    assert wallet, not None
+    response = await client.get(
+        "/atmbitbit/api/v1/atmbitbits/config",
+        headers={"X-Api-Key": wallet.adminkey},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.namelist() == [f"{atmbitbit.api_key_id}/atmbitbit.conf"]
+    lines = archive.read(archive.namelist()[0]).decode().split("\n")
+    assert f"apiKey.id={atmbitbit.api_key_id}" in lines
+    assert f"apiKey.key={atmbitbit.api_key_secret}" in lines
+    assert f"apiKey.encoding={atmbitbit.api_key_encoding}" in lines
+    assert f"fiatCurrency={atmbitbit.fiat_currency}" in lines
+    assert "shorten=true" in lines
+
+
+@pytest.mark.asyncio
+async def test_atmbitbits_list_not_modified(client, atmbitbit):
+    wallet = await get_wallet(atmbitbit.wallet)
+    assert wallet, not None
+    headers = {"X-Api-Key": wallet.adminkey}
+    response = await client.get("/atmbitbit/api/v1/atmbitbits", headers=headers)
+    assert response.status_code == 200
+    assert [obj["id"] for obj in response.json()] == [atmbitbit.id]
+    etag = response.headers["etag"]
+    response = await client.get(
+        "/atmbitbit/api/v1/atmbitbits", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    response = await client.put(
+        f"/atmbitbit/api/v1/atmbitbit/{atmbitbit.id}",
+        headers=headers,
+        json={
+            "name": "Renamed AtmBitBit",
+            "fiat_currency": "EUR",
+            "exchange_rate_provider": "dummy",
+            "fee": "0",
+        },
+    )
+    assert response.status_code == 200
+    response = await client.get(
+        "/atmbitbit/api/v1/atmbitbits", headers={**headers, "If-None-Match": etag}
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()[0]["name"] == "Renamed AtmBitBit"
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_bootstrap_cached(client):
+    response = await client.get("/atmbitbit/api/v1/bootstrap.json")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, no-cache"
+    data = response.json()
+    assert data["fiat_currencies"]["EUR"] == "Euro"
+    assert data["exchange_rate_providers"]["coinbase"]["name"] == "Coinbase"
+    assert "getter" not in data["exchange_rate_providers"]["coinbase"]
+    etag = response.headers["etag"]
+    version = etag.strip('"')
+    response = await client.get(f"/atmbitbit/api/v1/bootstrap.json?v={version}")
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
+    response = await client.get(
+        f"/atmbitbit/api/v1/bootstrap.json?v={version}",
+        headers={"If-None-Match": etag},
+    )
+    assert response.status_code == 304
+
+
+@pytest.mark.asyncio
+async def test_atmbitbit_withdrawals_export(client, lnurl):
+    atmbitbit = lnurl["atmbitbit"]
+    wallet = await get_wallet(atmbitbit.wallet)
+    assert wallet, not None
+    headers = {"X-Api-Key": wallet.adminkey}
+    url = f"/atmbitbit/api/v1/atmbitbit/{atmbitbit.id}/withdrawals"
+    response = await client.get(url, headers=headers)
+    assert response.status_code == 200
+    # Unused LNURLs are not withdrawals.
+    assert response.text.split("\n")[1:] == [""]
+    # Every payment is its own row, also for LNURLs with several uses.
+    first = await create_atmbitbit_withdrawal(lnurl["lnurl"], 50000, "hash-1")
+    await create_atmbitbit_withdrawal(lnurl["lnurl"], 20000, "hash-2")
+    response = await client.get(f"{url}?format=jsonl", headers=headers)
+    assert response.status_code == 200
+    records = [json.loads(line) for line in response.text.splitlines()]
+    assert len(records) == 2
+    assert {record["lnurl"] for record in records} == {lnurl["lnurl"].id}
+    assert sorted(record["amount_msat"] for record in records) == [20000, 50000]
+    assert sorted(record["payment_hash"] for record in records) == [
+        "hash-1",
+        "hash-2",
+    ]
+    response = await client.get(
+        f"{url}?since={first.created_time + 1}", headers=headers
+    )
+    assert response.text.split("\n")[1:] == [""]
@@ -0,0 +1,123 @@
+import json
+import time
+
+import httpx
+import pytest
+from pydantic import ValidationError
+
+from lnbits.extensions.atmbitbit import db, webhooks
+from lnbits.extensions.atmbitbit.crud import (
+    claim_webhook_delivery,
+    create_webhook_delivery,
+    get_due_webhook_deliveries,
+    update_atmbitbit,
+)
+from lnbits.extensions.atmbitbit.helpers import (
+    check_webhook_url,
+    generate_atmbitbit_lnurl_signature,
+)
+from lnbits.extensions.atmbitbit.models import CreateAtmBitBit
+from lnbits.extensions.atmbitbit.webhooks import WebhookDispatcher
+
+
+async def get_outbox(atmbitbit_id: str):
+    return await db.fetchall(
+        "SELECT * FROM atmbitbit.webhook_outbox WHERE atmbitbit = ?", (atmbitbit_id,)
+    )
+
+
+async def skip_webhook_url_check(url: str) -> None:
+    # operator.example doesn't resolve.
+    pass
+
+
+@pytest.mark.asyncio
+async def test_webhook_delivery(atmbitbit, monkeypatch):
+    monkeypatch.setattr(webhooks, "check_webhook_url", skip_webhook_url_check)
+    atmbitbit = await update_atmbitbit(
+        atmbitbit.id, webhook_url="https://operator.example/hook"
+    )
+    await create_webhook_delivery(atmbitbit, json.dumps({"event": "test"}))
+    deliveries = [
+        delivery
+        for delivery in await get_due_webhook_deliveries()
+        if delivery.atmbitbit == atmbitbit.id
+    ]
+    assert len(deliveries) == 1
+    dispatcher = WebhookDispatcher()
+    requests = []
+
+    def failing(request):
+        return httpx.Response(503)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(failing)) as client:
+        await dispatcher.deliver(client, deliveries[0])
+    rows = await get_outbox(atmbitbit.id)
+    assert rows[0]["status"] == "pending"
+    assert rows[0]["attempts"] == 1
+    assert rows[0]["next_attempt_time"] >= deliveries[0].created_time + 10
+
+    def succeeding(request):
+        requests.append(request)
+        return httpx.Response(200)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(succeeding)) as client:
+        await dispatcher.deliver(client, deliveries[0])
+    assert json.loads(requests[0].content) == {"event": "test"}
+    assert requests[0].headers[
+        "X-AtmBitBit-Signature"
+    ] == generate_atmbitbit_lnurl_signature(
+        requests[0].content.decode(),
+        atmbitbit.api_key_secret,
+        atmbitbit.api_key_encoding,
+    )
+    assert await get_outbox(atmbitbit.id) == []
+
+
+def test_webhook_retry_delay():
+    dispatcher = WebhookDispatcher(base_delay=10, max_delay=60)
+    delays = [dispatcher.get_retry_delay(attempts) for attempts in range(1, 6)]
+    assert delays == [10, 20, 40, 60, 60]
+
+
+@pytest.mark.asyncio
+async def test_webhook_delivery_is_claimed_once(atmbitbit):
+    atmbitbit = await update_atmbitbit(
+        atmbitbit.id, webhook_url="https://operator.example/hook"
+    )
+    await create_webhook_delivery(atmbitbit, json.dumps({"event": "test"}))
+    delivery = [
+        delivery
+        for delivery in await get_due_webhook_deliveries()
+        if delivery.atmbitbit == atmbitbit.id
+    ][0]
+    # Two workers read the same row: only the first claim succeeds.
+    lease_until = int(time.time()) + 60
+    assert await claim_webhook_delivery(delivery, lease_until) is True
+    assert await claim_webhook_delivery(delivery, lease_until) is False
+    rows = await get_outbox(atmbitbit.id)
+    assert rows[0]["status"] == "sending"
+    assert delivery.id not in [
+        delivery.id for delivery in await get_due_webhook_deliveries()
+    ]
+
+
+@pytest.mark.asyncio
+async def test_webhook_url_must_be_public():
+    for url in [
+        "http://localhost:5000/hook",
+        "http://127.0.0.1/hook",
+        "http://10.0.0.1/hook",
+        "http://169.254.169.254/latest/meta-data",
+        "http://[::1]/hook",
+    ]:
+        with pytest.raises(ValidationError):
+            CreateAtmBitBit(
+                name="Test AtmBitBit",
+                fiat_currency="EUR",
+                exchange_rate_provider="dummy",
+                fee="0",
+                webhook_url=url,
+            )
+        with pytest.raises(ValueError):
+            await check_webhook_url(url)
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import secrets
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional
+
+from loguru import logger
+
+from .helpers import generate_atmbitbit_lnurl_secret, unshorten_lnurl_query
+
+# Query values kept as they are. Everything else (API key ID, nonce,
+# signature, k1, invoice, description, ...) is replaced by a pseudonym.
+traffic_plain_keys = {
+    "t",
+    "tag",
+    "f",
+    "pn",
+    "px",
+    "minWithdrawable",
+    "maxWithdrawable",
+}
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # Drop records rather than wait when the writer thread falls behind.
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def get_trace_salt(path: str) -> bytes:
+    # Every process recording into the same trace has to use the same salt, or
+    # a callback handled by another worker than its signed request can't be
+    # linked to it. The first process stores one next to the trace.
+    salt = os.getenv("ATMBITBIT_TRAFFIC_RECORD_SALT")
+    if salt:
+        return salt.encode()
+    salt_path = path + ".salt"
+    try:
+        if not os.path.exists(salt_path):
+            tmp_path = f"{salt_path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                f.write(secrets.token_hex(16))
+            try:
+                # Atomic: a process that loses the race reads the winner's salt.
+                os.link(tmp_path, salt_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(tmp_path)
+        with open(salt_path) as f:
+            return bytes.fromhex(f.read())
+    except (OSError, ValueError) as e:
+        # E.g. no hard links on this filesystem. Recording must not keep the
+        # extension from loading.
+        logger.warning(
+            f"Failed to share the traffic trace salt through {salt_path} ({e}),"
+            " set ATMBITBIT_TRAFFIC_RECORD_SALT to link requests across workers"
+        )
+        return secrets.token_bytes(16)
+
+
+def get_process_trace_path(path: str) -> str:
+    # One file per process: they would rotate a shared file independently.
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+class TrafficRecorder:
+    """
+    Writes one JSON line per /u request to a size-rotated file: arrival time,
+    duration, sanitized query and outcome. Pseudonyms are salted, so they link
+    the requests of one trace but can't be reversed. Signed requests also
+    record the pseudonym of the k1 they create, which lets replay.py follow
+    them with their callbacks.
+
+    Writing happens on a background thread, never on the event loop.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 10_000_000,
+        backups: int = 5,
+        salt: Optional[bytes] = None,
+    ):
+        self._salt = salt or secrets.token_bytes(16)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._queue: queue.Queue = queue.Queue(maxsize=10000)
+        self._listener = QueueListener(self._queue, handler)
+        self._listener.start()
+        self._logger = logging.getLogger(f"atmbitbit.traffic.{id(self)}")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(_DroppingQueueHandler(self._queue))
+
+    def pseudonym(self, value: str) -> str:
+        return hashlib.sha256(self._salt + value.encode()).hexdigest()[:16]
+
+    def sanitize(self, query: Dict[str, str]) -> Dict[str, str]:
+        return {
+            key: value if key in traffic_plain_keys else self.pseudonym(value)
+            for key, value in query.items()
+        }
+
+    def record(
+        self, query: Dict[str, str], started: float, duration: float, response: dict
+    ) -> None:
+        record: dict = {
+            # Wall clock time, so that the files of several processes merge.
+            "t": round(started, 3),
+            "d": round(duration * 1000, 1),
+            "q": self.sanitize(query),
+            "r": response.get("status") or response.get("tag"),
+        }
+        if "reason" in response:
+            record["e"] = response["reason"]
+        k1 = self.get_signed_k1(query)
+        if k1:
+            record["k1"] = self.pseudonym(k1)
+        self._logger.info(json.dumps(record, separators=(",", ":")))
+
+    def get_signed_k1(self, query: Dict[str, str]) -> Optional[str]:
+        try:
+            if "s" in query:
+                query = unshorten_lnurl_query(query)
+            if "signature" in query and "id" in query:
+                return generate_atmbitbit_lnurl_secret(query["id"], query["signature"])
+        except Exception:
+            pass
+        return None
+
+    def stop(self) -> None:
+        self._listener.stop()
+
+
+# Opt-in: set ATMBITBIT_TRAFFIC_RECORD to the path of the trace. Each process
+# writes to that path with its PID inserted before the extension.
+traffic_recorder: Optional[TrafficRecorder] = None
+if os.getenv("ATMBITBIT_TRAFFIC_RECORD"):
+    traffic_recorder = TrafficRecorder(
+        get_process_trace_path(os.environ["ATMBITBIT_TRAFFIC_RECORD"]),
+        max_bytes=int(os.getenv("ATMBITBIT_TRAFFIC_RECORD_MAX_BYTES", "10000000")),
+        salt=get_trace_salt(os.environ["ATMBITBIT_TRAFFIC_RECORD"]),
+    )
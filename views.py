@@ -6,7 +6,7 @@ from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 
 from . import atmbitbit_ext, atmbitbit_renderer
-from .exchange_rates import exchange_rate_providers_serializable, fiat_currencies
+from .bootstrap import dashboard_bootstrap
 from .helpers import get_callback_url
 
 templates = Jinja2Templates(directory="templates")
@@ -16,8 +16,9 @@ templates = Jinja2Templates(directory="templates")
 async def index(req: Request, user: User = Depends(check_user_exists)):
     atmbitbit_vars = {
         "callback_url": get_callback_url(req),
-        "exchange_rate_providers": exchange_rate_providers_serializable,
-        "fiat_currencies": fiat_currencies,
+        # Static data is fetched from a versioned, publicly cached URL.
+        "bootstrap_url": str(req.url_for("atmbitbit.api_atmbitbit_bootstrap"))
+        + f"?v={dashboard_bootstrap.version}",
     }
     return atmbitbit_renderer().TemplateResponse(
         "atmbitbit/index.html",
@@ -1,29 +1,133 @@
+import csv
+import hashlib
+import io
+import json
 from http import HTTPStatus
+from typing import List, Optional
 
-from fastapi import Depends, Query
+from fastapi import Depends, Query, Request
 from loguru import logger
+from sse_starlette.sse import EventSourceResponse
 from starlette.exceptions import HTTPException
+from starlette.responses import Response, StreamingResponse
 
 from lnbits.core.crud import get_user
-from lnbits.decorators import WalletTypeInfo, require_admin_key
+from lnbits.decorators import WalletTypeInfo, require_admin_key, require_invoice_key
 
 from . import atmbitbit_ext
+from .admission import admission_controller
+from .bootstrap import dashboard_bootstrap
 from .crud import (
     create_atmbitbit,
     delete_atmbitbit,
     get_atmbitbit,
     get_atmbitbit_by_api_key_id,
+    get_atmbitbit_generations,
+    get_atmbitbit_withdrawal_rollups,
+    get_atmbitbit_withdrawals,
     get_atmbitbits,
     update_atmbitbit,
 )
+from .events import atmbitbit_events
 from .exchange_rates import fetch_fiat_exchange_rate
+from .helpers import check_webhook_url, get_callback_url, stream_atmbitbit_config_zip
 from .models import CreateAtmBitBit
 
 
+async def get_atmbitbits_etag(
+    wallet_ids: List[str], limit: Optional[int], after: Optional[str]
+) -> str:
+    # The listing only changes when one of the wallets' generations changes.
+    generations = await get_atmbitbit_generations(wallet_ids)
+    state = [[wallet_id, generations.get(wallet_id, 0)] for wallet_id in wallet_ids]
+    payload = json.dumps([sorted(state), limit, after])
+    return '"' + hashlib.sha256(payload.encode()).hexdigest()[:32] + '"'
+
+
+@atmbitbit_ext.get("/api/v1/bootstrap.json", name="atmbitbit.api_atmbitbit_bootstrap")
+async def api_atmbitbit_bootstrap(req: Request, v: Optional[str] = Query(None)):
+    body, version = dashboard_bootstrap.get()
+    etag = f'"{version}"'
+    if v == version:
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        # Unversioned or outdated URL: caches have to revalidate.
+        cache_control = "public, no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if req.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 @atmbitbit_ext.get("/api/v1/atmbitbits")
 async def api_atmbitbits(
+    req: Request,
+    response: Response,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    all_wallets: bool = Query(False),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    after: Optional[str] = Query(None),
+):
+    wallet_ids = [wallet.wallet.id]
+
+    if all_wallets:
+        user = await get_user(wallet.wallet.user)
+        wallet_ids = user.wallet_ids if user else []
+
+    etag = await get_atmbitbits_etag(wallet_ids, limit, after)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if req.headers.get("if-none-match") == etag:
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    atmbitbits = await get_atmbitbits(wallet_ids, limit=limit, after=after)
+    response.headers.update(headers)
+    if limit is not None and len(atmbitbits) == limit:
+        # Pass this back as "after" to get the next page.
+        response.headers["X-Next-After"] = atmbitbits[-1].id
+
+    return [atmbitbit.dict() for atmbitbit in atmbitbits]
+
+
+@atmbitbit_ext.get("/api/v1/atmbitbits/config")
+async def api_atmbitbits_config_files(
+    req: Request,
     wallet: WalletTypeInfo = Depends(require_admin_key),
     all_wallets: bool = Query(False),
+    ids: Optional[str] = Query(None),
+):
+    wallet_ids = [wallet.wallet.id]
+
+    if all_wallets:
+        user = await get_user(wallet.wallet.user)
+        wallet_ids = user.wallet_ids if user else []
+
+    atmbitbit_ids = set(ids.split(",")) if ids else None
+
+    async def atmbitbits():
+        after = None
+        while True:
+            page = await get_atmbitbits(wallet_ids, limit=100, after=after)
+            for atmbitbit in page:
+                if atmbitbit_ids is None or atmbitbit.id in atmbitbit_ids:
+                    yield atmbitbit.dict()
+            if len(page) < 100:
+                break
+            after = page[-1].id
+
+    return StreamingResponse(
+        stream_atmbitbit_config_zip(atmbitbits(), str(get_callback_url(req))),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="atmbitbit.zip"'},
+    )
+
+
+# Read-only. EventSource can't send headers, so the dashboard passes its key in
+# the URL: the invoice key, which ends up in access logs instead of the admin key.
+@atmbitbit_ext.get("/api/v1/events")
+async def api_atmbitbit_events(
+    req: Request,
+    wallet: WalletTypeInfo = Depends(require_invoice_key),
+    all_wallets: bool = Query(False),
 ):
     wallet_ids = [wallet.wallet.id]
 
@@ -31,7 +135,42 @@ async def api_atmbitbits(
         user = await get_user(wallet.wallet.user)
         wallet_ids = user.wallet_ids if user else []
 
-    return [atmbitbit.dict() for atmbitbit in await get_atmbitbits(wallet_ids)]
+    last_event_id = req.headers.get("last-event-id")
+
+    async def event_stream():
+        with atmbitbit_events.subscribe(wallet_ids) as subscription:
+            if last_event_id:
+                # Reconnecting client: send what it missed, or ask it to reload
+                # everything when the missed events are no longer available.
+                missed = atmbitbit_events.replay(last_event_id, wallet_ids)
+                if missed is None:
+                    yield {"event": "resync", "data": "{}"}
+                    missed = []
+                for event in missed:
+                    yield {
+                        "id": event.id,
+                        "event": event.type,
+                        "data": json.dumps(event.data),
+                    }
+            # An overflowed subscription ends the stream. The browser reconnects
+            # with the last event ID it received and catches up from there.
+            while not subscription.overflowed:
+                event = await subscription.queue.get()
+                yield {
+                    "id": event.id,
+                    "event": event.type,
+                    "data": json.dumps(event.data),
+                }
+
+    return EventSourceResponse(event_stream())
+
+
+@atmbitbit_ext.get("/api/v1/admission")
+async def api_atmbitbit_admission(
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+):
+    # Concurrency and shed counters of the /u endpoint on this worker.
+    return admission_controller.stats()
 
 
 @atmbitbit_ext.get("/api/v1/fetch_atm/{api_key_id}")
@@ -64,6 +203,84 @@ async def api_atmbitbit_retrieve(
     return atmbitbit.dict()
 
 
+@atmbitbit_ext.get("/api/v1/atmbitbit/{atmbitbit_id}/rollups")
+async def api_atmbitbit_rollups(
+    atmbitbit_id,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    start: Optional[str] = Query(None, regex=r"^\d{4}-\d{2}-\d{2}$"),
+    end: Optional[str] = Query(None, regex=r"^\d{4}-\d{2}-\d{2}$"),
+):
+    atmbitbit = await get_atmbitbit(atmbitbit_id)
+
+    if not atmbitbit or atmbitbit.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="AtmBitBit configuration not found.",
+        )
+
+    rollups = await get_atmbitbit_withdrawal_rollups(atmbitbit_id, start, end)
+    return [rollup.dict() for rollup in rollups]
+
+
+@atmbitbit_ext.get("/api/v1/atmbitbit/{atmbitbit_id}/withdrawals")
+async def api_atmbitbit_withdrawals_export(
+    atmbitbit_id,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    format: str = Query("csv", regex="^(csv|jsonl)$"),
+    since: Optional[int] = Query(None),
+    until: Optional[int] = Query(None),
+):
+    atmbitbit = await get_atmbitbit(atmbitbit_id)
+
+    if not atmbitbit or atmbitbit.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="AtmBitBit configuration not found.",
+        )
+
+    fields = [
+        "id",
+        "created_time",
+        "lnurl",
+        "payment_hash",
+        "amount_msat",
+        "fiat_currency",
+        "fiat_amount",
+        "exchange_rate",
+        "fee_msat",
+    ]
+
+    async def export():
+        # Each page is a separate query, so only one page is ever held in
+        # memory and other requests get to run in between.
+        if format == "csv":
+            yield ",".join(fields) + "\n"
+        after = None
+        while True:
+            page = await get_atmbitbit_withdrawals(
+                atmbitbit_id, since=since, until=until, after=after, limit=500
+            )
+            records = [withdrawal.dict(include=set(fields)) for withdrawal in page]
+            if format == "csv":
+                buffer = io.StringIO()
+                writer = csv.DictWriter(buffer, fieldnames=fields, lineterminator="\n")
+                writer.writerows(records)
+                yield buffer.getvalue()
+            else:
+                yield "".join(json.dumps(record) + "\n" for record in records)
+            if len(page) < 500:
+                break
+            after = (page[-1].created_time, page[-1].id)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"atmbitbit-{atmbitbit.api_key_id}-withdrawals.{format}"
+    return StreamingResponse(
+        export(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @atmbitbit_ext.post("/api/v1/atmbitbit")
 @atmbitbit_ext.put("/api/v1/atmbitbit/{atmbitbit_id}")
 async def api_atmbitbit_create_or_update(
@@ -84,6 +301,13 @@ async def api_atmbitbit_create_or_update(
             detail=f'Failed to fetch BTC/{fiat_currency} currency pair from "{exchange_rate_provider}"',
         )
 
+    if data.webhook_url:
+        # The validator can't resolve names: refuse those of internal hosts here.
+        try:
+            await check_webhook_url(data.webhook_url)
+        except ValueError as e:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
     if atmbitbit_id:
         atmbitbit = await get_atmbitbit(atmbitbit_id)
         if not atmbitbit or atmbitbit.wallet != wallet.wallet.id:
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from typing import Dict, Set
+from urllib.parse import urlparse
+
+import httpx
+from loguru import logger
+
+from .crud import (
+    claim_webhook_delivery,
+    delete_webhook_delivery,
+    get_due_webhook_deliveries,
+    update_webhook_delivery,
+)
+from .helpers import check_webhook_url
+from .models import WebhookDelivery
+
+
+class WebhookDispatcher:
+    """
+    Delivers the rows of the webhook outbox with a pool of workers sharing one
+    HTTP client. Failed deliveries are retried with exponential backoff until
+    max_attempts, and no destination host gets more than per_destination
+    requests at a time. Deliveries are claimed in the database before they
+    are sent, so that a webhook is posted once even with several workers.
+
+    Payloads carry their HMAC-SHA256, keyed with the ATM's API key secret, in
+    the X-AtmBitBit-Signature header. The destination is resolved again before
+    every attempt and refused when it points at a non-public address.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        per_destination: int = 2,
+        max_attempts: int = 10,
+        base_delay: int = 10,
+        max_delay: int = 3600,
+        timeout: float = 10.0,
+        poll_interval: float = 30.0,
+        lease: int = 60,
+    ):
+        self.workers = workers
+        self.per_destination = per_destination
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # Seconds a claimed delivery is left to this process.
+        self.lease = lease
+        self._wakeup = asyncio.Event()
+        self._in_flight: Set[str] = set()
+        self._destinations: Dict[str, int] = {}
+
+    def notify(self) -> None:
+        # Called after a delivery was added to the outbox.
+        self._wakeup.set()
+
+    def get_retry_delay(self, attempts: int) -> int:
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    async def run(self) -> None:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers)
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            workers = [
+                asyncio.create_task(self._work(client, queue))
+                for _ in range(self.workers)
+            ]
+            try:
+                while True:
+                    self._wakeup.clear()
+                    queued = 0
+                    for delivery in await get_due_webhook_deliveries():
+                        if delivery.id in self._in_flight:
+                            continue
+                        # Deliveries to a saturated host are left for a later
+                        # round instead of tying up a worker.
+                        host = urlparse(delivery.url).netloc
+                        if self._destinations.get(host, 0) >= self.per_destination:
+                            continue
+                        lease_until = int(time.time()) + self.lease
+                        if not await claim_webhook_delivery(delivery, lease_until):
+                            continue
+                        self._in_flight.add(delivery.id)
+                        self._destinations[host] = self._destinations.get(host, 0) + 1
+                        await queue.put(delivery)
+                        queued += 1
+                    if not queued:
+                        try:
+                            await asyncio.wait_for(
+                                self._wakeup.wait(), self.poll_interval
+                            )
+                        except asyncio.TimeoutError:
+                            pass
+            finally:
+                for worker in workers:
+                    worker.cancel()
+
+    async def _work(self, client: httpx.AsyncClient, queue: asyncio.Queue) -> None:
+        while True:
+            delivery = await queue.get()
+            try:
+                await self.deliver(client, delivery)
+            except Exception as e:
+                logger.error(f"AtmBitBit webhook {delivery.id} failed: {e}")
+            finally:
+                self._in_flight.discard(delivery.id)
+                host = urlparse(delivery.url).netloc
+                self._destinations[host] -= 1
+                if not self._destinations[host]:
+                    del self._destinations[host]
+                # Retries may have become due while this worker was busy.
+                self._wakeup.set()
+
+    async def deliver(self, client: httpx.AsyncClient, delivery: WebhookDelivery):
+        headers = {"Content-Type": "application/json"}
+        if delivery.signature:
+            headers["X-AtmBitBit-Signature"] = delivery.signature
+        try:
+            await check_webhook_url(delivery.url)
+            r = await client.post(
+                delivery.url, content=delivery.payload, headers=headers
+            )
+            r.raise_for_status()
+        except Exception as e:
+            attempts = delivery.attempts + 1
+            if attempts >= self.max_attempts:
+                logger.warning(f"Giving up on AtmBitBit webhook {delivery.id}: {e}")
+                await update_webhook_delivery(
+                    delivery.id,
+                    status="failed",
+                    attempts=attempts,
+                    last_error=str(e),
+                )
+            else:
+                await update_webhook_delivery(
+                    delivery.id,
+                    status="pending",
+                    attempts=attempts,
+                    last_error=str(e),
+                    next_attempt_time=int(time.time()) + self.get_retry_delay(attempts),
+                )
+            return
+        await delete_webhook_delivery(delivery.id)
+
+
+webhook_dispatcher = WebhookDispatcher()